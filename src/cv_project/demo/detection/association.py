@@ -0,0 +1,137 @@
+"""Which chicken each egg belongs to, without Qt"""
+
+import lap
+import numpy as np
+from numpy.typing import NDArray
+
+# x1, y1, x2, y2 of each rectangle, inclusive as in `QRect`
+Rects = NDArray[np.float32]
+# Index of the chicken of each egg, -1 for none
+Owners = NDArray[np.int64]
+
+# Scenes with more egg-chicken pairs than this look only at nearby chickens
+GRID_MIN_PAIRS = 1_000_000
+
+
+def rects(coords: list[tuple[float, float, float, float]]) -> Rects:
+    return np.array(coords, dtype=np.float32).reshape(-1, 4)
+
+
+def rect_distances(a: Rects, b: Rects):
+    """Distance between the closest points of each rectangle of `a` and `b`
+
+    Rectangles which intersect are 0 apart.
+    """
+    dx = np.maximum(b[None, :, 0] - a[:, None, 2], a[:, None, 0] - b[None, :, 2])
+    dy = np.maximum(b[None, :, 1] - a[:, None, 3], a[:, None, 1] - b[None, :, 3])
+    return np.hypot(np.maximum(dx, 0), np.maximum(dy, 0))
+
+
+def associate(
+    eggs: Rects, chickens: Rects, capacity: int = 0, cell: float | None = None
+) -> Owners:
+    """The closest chicken of each egg
+
+    With `capacity`, a chicken gets at most that many eggs and the total
+    distance is minimized. Eggs which do not fit are left without a chicken.
+    Otherwise, scenes with many objects are split into a grid of `cell`
+    pixels; None picks a cell size for scenes above `GRID_MIN_PAIRS`, 0
+    never uses the grid.
+    """
+    if len(eggs) == 0 or len(chickens) == 0:
+        return np.full(len(eggs), -1, dtype=np.int64)
+    if capacity > 0:
+        return assign(eggs, chickens, capacity)
+
+    if cell is None and len(eggs) * len(chickens) > GRID_MIN_PAIRS:
+        cell = grid_cell(chickens)
+    if cell:
+        return nearest_in_grid(eggs, chickens, cell)
+    return np.argmin(rect_distances(eggs, chickens), axis=1)
+
+
+def grid_cell(chickens: Rects):
+    """A cell size for which most eggs have a chicken in the cells around them
+
+    About the size of a chicken, larger when chickens are far apart.
+    """
+    size = float(np.median(chickens[:, 2:] - chickens[:, :2] + 1))
+    width, height = (chickens[:, 2:].max(axis=0) - chickens[:, :2].min(axis=0)).tolist()
+    spacing = (width * height / len(chickens)) ** 0.5
+    return max(size, spacing, 1.0)
+
+
+def assign(eggs: Rects, chickens: Rects, capacity: int) -> Owners:
+    """Optimal assignment of eggs to chickens taking up to `capacity` each"""
+    dists = rect_distances(eggs, chickens)
+    # A column per place next to a chicken
+    cost = np.repeat(dists, capacity, axis=1).astype(np.float64)
+    _, x, _ = lap.lapjv(cost, extend_cost=True)
+    return np.where(x >= 0, x // capacity, -1).astype(np.int64)
+
+
+def nearest_in_grid(eggs: Rects, chickens: Rects, cell: float) -> Owners:
+    """Same as the closest chicken of each egg, looking at nearby cells first
+
+    Only chickens in the cells around an egg are measured. Chickens beyond
+    them are more than `cell` away, eggs without a chicken as close as that
+    are measured against all chickens.
+    """
+    chicken_cells = (chickens // cell).astype(np.int64)
+    # The cells around each egg
+    egg_cells = (eggs // cell).astype(np.int64) + np.array([-1, -1, 1, 1])
+    chicken_of, chicken_xy = covered(chicken_cells)
+    egg_of, egg_xy = covered(egg_cells)
+
+    # Number each cell, then pair the eggs and chickens of a cell
+    start = np.minimum(chicken_xy.min(axis=0), egg_xy.min(axis=0))
+    height = max(chicken_xy[:, 1].max(), egg_xy[:, 1].max()) - start[1] + 1
+    chicken_keys = (chicken_xy[:, 0] - start[0]) * height + chicken_xy[:, 1] - start[1]
+    egg_keys = (egg_xy[:, 0] - start[0]) * height + egg_xy[:, 1] - start[1]
+
+    order = np.argsort(chicken_keys, kind="stable")
+    chicken_keys = chicken_keys[order]
+    first = np.searchsorted(chicken_keys, egg_keys, side="left")
+    counts = np.searchsorted(chicken_keys, egg_keys, side="right") - first
+    pair_eggs = np.repeat(egg_of, counts)
+    pair_chickens = chicken_of[order[np.repeat(first, counts) + ranks(counts)]]
+
+    dx = np.maximum(
+        chickens[pair_chickens, 0] - eggs[pair_eggs, 2],
+        eggs[pair_eggs, 0] - chickens[pair_chickens, 2],
+    )
+    dy = np.maximum(
+        chickens[pair_chickens, 1] - eggs[pair_eggs, 3],
+        eggs[pair_eggs, 1] - chickens[pair_chickens, 3],
+    )
+    dists = np.hypot(np.maximum(dx, 0), np.maximum(dy, 0))
+
+    res = np.full(len(eggs), -1, dtype=np.int64)
+    if len(pair_eggs):
+        # The closest chicken of each egg comes first, the lower index on a tie
+        pairs = np.lexsort((pair_chickens, dists, pair_eggs))
+        heads = pairs[np.r_[True, pair_eggs[pairs][1:] != pair_eggs[pairs][:-1]]]
+        close = heads[dists[heads] <= cell]
+        res[pair_eggs[close]] = pair_chickens[close]
+
+    far = np.flatnonzero(res < 0)
+    if len(far):
+        res[far] = np.argmin(rect_distances(eggs[far], chickens), axis=1)
+    return res
+
+
+def covered(cells: NDArray[np.int64]):
+    """Index and x, y of each cell covered by the rectangles of `cells`"""
+    widths = cells[:, 2] - cells[:, 0] + 1
+    counts = widths * (cells[:, 3] - cells[:, 1] + 1)
+    of = np.repeat(np.arange(len(cells)), counts)
+    offsets = ranks(counts)
+    x = cells[of, 0] + offsets % widths[of]
+    y = cells[of, 1] + offsets // widths[of]
+    return of, np.stack([x, y], axis=1)
+
+
+def ranks(counts: NDArray[np.int64]):
+    """0 to `count` - 1 for each of `counts`, one after the other"""
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(starts, counts)
@@ -0,0 +1,188 @@
+"""Measures detection without the GUI, talking to a `Processor` directly"""
+
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import redirect_stdout
+from dataclasses import asdict
+from multiprocessing import Pipe
+from multiprocessing.connection import Connection
+from typing import Any, cast, get_args
+
+import numpy as np
+
+from .latency import PERCENTILES, LatencyStats
+from .schemas import (
+    Backend,
+    CmdAckFrame,
+    CmdGetStats,
+    CmdSetModel,
+    CmdSetSrc,
+    CmdStartStream,
+    CmdStopStream,
+    CmdTerminate,
+    MsgTerminated,
+    ReplyGetFrame,
+    ReplyGetStats,
+    ReplySetModel,
+    ReplySetSrc,
+    SrcType,
+)
+
+# Images the benchmark holds at a time, as the runner does when streaming
+CREDITS = 2
+
+
+def percentiles(samples: list[float]):
+    if not samples:
+        return {}
+    values = np.percentile(samples, PERCENTILES).tolist()
+    return {f"p{p}": v for p, v in zip(PERCENTILES, values)}
+
+
+def benchmark(
+    model: str,
+    backend: Backend,
+    src_type: SrcType,
+    src_value: str,
+    frames: int = 0,
+    seconds: float = 0.0,
+    **src_options: Any,
+):
+    """Stream frames of a source through a `Processor` in this process
+
+    Stops after `frames` frames or `seconds` seconds, whichever comes first,
+    or when the source ends. `src_options` are passed on to `CmdSetSrc`.
+    """
+    from .process import Processor
+
+    here, there = Pipe()
+    conn = cast(Connection, cast(object, here))
+    processor = Processor(cast(Connection, cast(object, there)))
+    thread = threading.Thread(target=processor.run, daemon=True)
+    thread.start()
+
+    try:
+        conn.send(CmdSetModel(model, backend))
+        reply = conn.recv()
+        assert isinstance(reply, ReplySetModel)
+        if not reply.ok:
+            raise RuntimeError("loading model failed", model, backend)
+
+        conn.send(CmdSetSrc(src_type, src_value, **src_options))
+        reply = conn.recv()
+        assert isinstance(reply, ReplySetSrc)
+        if not reply.ok:
+            raise RuntimeError("opening source failed", src_type, src_value)
+
+        usage_start = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.monotonic()
+        conn.send(CmdStartStream(CREDITS))
+
+        latencies: list[float] = []
+        model_latencies: list[float] = []
+        stages = LatencyStats(window=1 << 20)
+        count = 0
+        stopping = False
+        while True:
+            reply = conn.recv()
+            assert isinstance(reply, ReplyGetFrame)
+            if not reply.ok:
+                break
+            reply.times.received = time.monotonic()
+            conn.send(CmdAckFrame(reply.idx))
+            if stopping:
+                continue
+
+            count += 1
+            stages.add(reply.times)
+            latencies.append((reply.times.received - reply.times.read) * 1000)
+            if reply.latency > 0:
+                model_latencies.append(reply.latency)
+
+            elapsed = time.monotonic() - start
+            if (frames > 0 and count >= frames) or (seconds > 0 and elapsed >= seconds):
+                conn.send(CmdStopStream())
+                stopping = True
+
+        elapsed = time.monotonic() - start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        conn.send(CmdGetStats())
+        # The end of the stream may cross `CmdStopStream`
+        while not isinstance(stats := conn.recv(), ReplyGetStats):
+            pass
+    finally:
+        conn.send(CmdTerminate())
+        while not isinstance(conn.recv(), MsgTerminated):
+            pass
+        thread.join()
+        processor.reset_source()
+
+    cpu = usage.ru_utime - usage_start.ru_utime + usage.ru_stime - usage_start.ru_stime
+    return {
+        "model": model,
+        "backend": backend,
+        "source": src_value,
+        "frames": count,
+        "seconds": elapsed,
+        "fps": count / elapsed if elapsed > 0 else 0.0,
+        # From reading a frame until its reply arrived
+        "latency_ms": percentiles(latencies),
+        # Time the model took for detected frames
+        "model_ms": percentiles(model_latencies),
+        "stages_ms": {
+            name: {f"p{p}": v for p, v in zip(PERCENTILES, values)}
+            for name, values in stages.percentiles().items()
+        },
+        # Peak resident memory; `ru_maxrss` is in kilobytes on Linux
+        "max_rss_mb": usage.ru_maxrss / 1024,
+        # Percent of one core, over all threads of the process
+        "cpu_percent": 100 * cpu / elapsed if elapsed > 0 else 0.0,
+        "stats": asdict(stats),
+    }
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description=__doc__)
+    _ = parser.add_argument("--model", default="models/g0t0_e100b20s.pt")
+    _ = parser.add_argument("--backend", choices=get_args(Backend), default="torch")
+    _ = parser.add_argument("--src-type", choices=get_args(SrcType), default="video")
+    _ = parser.add_argument("--source", default="./video.mp4")
+    _ = parser.add_argument("--frames", type=int, default=300)
+    _ = parser.add_argument("--seconds", type=float, default=0.0)
+    _ = parser.add_argument("--batch", type=int, default=1)
+    _ = parser.add_argument("--depth", type=int, default=0)
+    _ = parser.add_argument("--keyframe-interval", type=int, default=1)
+    _ = parser.add_argument("--no-track", action="store_true")
+    _ = parser.add_argument("--output", help="JSON file, printed if not given")
+    args = parser.parse_args()
+
+    # Keep what the processor prints out of the JSON
+    with redirect_stdout(sys.stderr):
+        res = benchmark(
+            args.model,
+            args.backend,
+            args.src_type,
+            args.source,
+            frames=args.frames,
+            seconds=args.seconds,
+            batch=args.batch,
+            depth=args.depth,
+            keyframe_interval=args.keyframe_interval,
+            track=not args.no_track,
+        )
+    out = json.dumps(res, indent=2)
+    if args.output is None:
+        print(out)
+    else:
+        with open(args.output, "w") as f:
+            _ = f.write(out + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+from cv_project.training.recipe_utils import DATA, output
+
+from .detector import files_of
+from .tracking import Boxes
+
+CACHE_DIR = DATA / "detections"
+
+
+def stat_key(path: str):
+    """Stands for the content of the file or directory at `path`
+
+    Its size and modification time, which is much faster to get than a
+    digest of a video or a model directory.
+    """
+    res: list[tuple[str, int, int]] = []
+    for file in files_of(Path(path)):
+        stat = file.stat()
+        res.append((str(file.resolve()), stat.st_size, stat.st_mtime_ns))
+    return res
+
+
+def load(path: Path) -> dict[int, Boxes]:
+    if not path.exists():
+        return {}
+    with np.load(path) as f:
+        frames = f["frames"]
+        offsets = f["offsets"]
+        boxes = f["boxes"]
+    return {
+        int(frame): boxes[start:end]
+        for frame, start, end in zip(frames, offsets[:-1], offsets[1:])
+    }
+
+
+class DetectionCache:
+    """Boxes found in the frames of a video, kept on disk between runs
+
+    Named by a digest of the video's and model's paths, sizes and
+    modification times, and of the `settings` which change what is
+    detected. Frames are numbered as in the video, so that the shards of a
+    split video share the file.
+    """
+
+    def __init__(self, video: str, model: str, settings: dict[str, object]):
+        digest = output.hash_object(
+            {"video": stat_key(video), "model": stat_key(model), "settings": settings}
+        ).hex()
+        self.path: Path = CACHE_DIR / f"{digest}.npz"
+        self.boxes: dict[int, Boxes] = load(self.path)
+        self.added: int = 0
+        print("detection cache", self.path, len(self.boxes), "frames")
+
+    def get(self, frame: int) -> Boxes | None:
+        return self.boxes.get(frame)
+
+    def put(self, frame: int, boxes: Boxes):
+        if frame < 0:
+            return
+        self.boxes[frame] = boxes
+        self.added += 1
+
+    def flush(self):
+        """Write the boxes, along with those other processes wrote meanwhile"""
+        if self.added == 0:
+            return
+        merged = load(self.path) | self.boxes
+        frames = sorted(merged)
+        counts = [len(merged[f]) for f in frames]
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            np.savez_compressed(
+                f,
+                frames=np.array(frames, dtype=np.int64),
+                offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                boxes=np.concatenate(
+                    [merged[f] for f in frames] + [np.empty((0, 6), np.float32)]
+                ).astype(np.float32),
+            )
+        _ = tmp.replace(self.path)
+        self.added = 0
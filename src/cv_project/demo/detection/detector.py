@@ -0,0 +1,179 @@
+import importlib.util
+import os
+import time
+from collections import OrderedDict
+from hashlib import file_digest, sha256
+from pathlib import Path
+
+import numpy as np
+from ultralytics import YOLO
+from ultralytics.engine.model import Model
+
+from ..utils import Img
+from .resolution import DEFAULT_SIZE, ImgSize
+from .schemas import Backend
+from .tracking import Boxes, result_boxes
+
+# Modules of the extra each backend is installed with, see pyproject.toml
+BACKEND_MODULES: dict[Backend, list[str]] = {
+    "torch": [],
+    "onnx": ["onnx", "onnxruntime"],
+    "openvino": ["openvino"],
+}
+
+
+def check_backend(backend: Backend):
+    """Fail with the extra to install if `backend` is not installed
+
+    Otherwise ultralytics would try to install it while loading the model.
+    """
+    missing = [m for m in BACKEND_MODULES[backend] if not importlib.util.find_spec(m)]
+    if missing:
+        raise RuntimeError(
+            f"backend {backend} needs {', '.join(missing)}: "
+            + f"install the project with its {backend} extra"
+        )
+
+
+def exported_path(model_path: str, backend: Backend) -> str:
+    """Path of the model for `backend`, exporting a PyTorch model if needed
+
+    Exported models are kept next to the PyTorch model, where ultralytics
+    puts them, and reused while they are newer than it.
+    """
+    path = Path(model_path)
+    match backend:
+        case "torch":
+            if path.suffix != ".pt":
+                raise RuntimeError("not a PyTorch model", model_path)
+            return model_path
+        case "onnx":
+            if path.suffix == ".onnx":
+                return model_path
+            exported = path.with_suffix(".onnx")
+        case "openvino":
+            if path.suffix == ".xml" or path.name.endswith("_openvino_model"):
+                return model_path
+            exported = path.with_name(path.stem + "_openvino_model")
+
+    if path.suffix != ".pt":
+        raise RuntimeError("cannot export", model_path, backend)
+    if exported.exists() and exported.stat().st_mtime >= path.stat().st_mtime:
+        return str(exported)
+
+    print("exporting", model_path, "for", backend)
+    # Dynamic shapes, so that batches of any size can be detected
+    return str(YOLO(model_path).export(format=backend, dynamic=True))
+
+
+def limit_threads(backend: Backend | None, threads: int):
+    """Let models of `backend` use up to `threads` threads, 0 for one per core
+
+    Backends other than PyTorch read the limit when a model is loaded, None
+    only sets it for those.
+    """
+    threads = threads or os.cpu_count() or 1
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    if backend != "torch":
+        return
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(threads)
+
+
+class Detector:
+    """A YOLO model run by `backend`, detecting objects in batches of frames"""
+
+    def __init__(self, model_path: str, backend: Backend = "torch"):
+        self.model_path: str = model_path
+        self.backend: Backend = backend
+        check_backend(backend)
+        self.model: Model = YOLO(exported_path(model_path, backend), task="detect")
+        # Exported models with a static batch size take one frame at a time
+        self.one_by_one: bool = False
+        # Time taken per frame by the last `predict`, in milliseconds
+        self.latency: float = 0.0
+
+    def warmup(self):
+        """Pay for lazy initialization with a dummy frame"""
+        _ = self.predict([np.zeros((640, 640, 3), dtype=np.uint8)])
+        self.latency = 0.0
+
+    def predict_results(self, imgs: list[Img], imgsz: ImgSize):
+        return self.model.predict(
+            imgs,
+            show=False,
+            verbose=False,
+            # Same as `Model.track`: ByteTrack needs low confidence predictions
+            conf=0.1,
+            imgsz=list(imgsz),
+        )
+
+    def predict(
+        self, imgs: list[Img], imgsz: ImgSize = (DEFAULT_SIZE, DEFAULT_SIZE)
+    ) -> list[Boxes]:
+        start = time.perf_counter()
+        if self.one_by_one:
+            results = [r for img in imgs for r in self.predict_results([img], imgsz)]
+        else:
+            try:
+                results = self.predict_results(imgs, imgsz)
+            except Exception:
+                if self.backend == "torch" or len(imgs) == 1:
+                    raise
+                print("batch rejected: detecting one frame at a time")
+                self.one_by_one = True
+                return self.predict(imgs, imgsz)
+        self.latency = (time.perf_counter() - start) * 1000 / len(imgs)
+
+        return [result_boxes(r) for r in results]
+
+
+def files_of(path: Path):
+    if path.is_dir():
+        return sorted(p for p in path.rglob("*") if p.is_file())
+    return [path]
+
+
+def path_digest(path: Path):
+    h = sha256()
+    for file in files_of(path):
+        with file.open("rb", buffering=0) as f:
+            h.update(file_digest(f, "sha256").digest())
+    return h.digest()
+
+
+class ModelCache:
+    """Loaded and warmed up models, by path, backend and content
+
+    The least recently used models are dropped while the model files take
+    more than `max_bytes`, which approximates the memory they use.
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30):
+        self.max_bytes: int = max_bytes
+        self.models: OrderedDict[tuple[str, Backend, bytes], tuple[Detector, int]] = (
+            OrderedDict()
+        )
+
+    def size(self):
+        return sum(size for _, size in self.models.values())
+
+    def get(self, model_path: str, backend: Backend) -> Detector:
+        path = Path(model_path)
+        key = (str(path.resolve()), backend, path_digest(path))
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key][0]
+
+        detector = Detector(model_path, backend)
+        detector.warmup()
+        size = sum(f.stat().st_size for f in files_of(path))
+        self.models[key] = (detector, size)
+
+        while len(self.models) > 1 and self.size() > self.max_bytes:
+            (dropped, _, _), _ = self.models.popitem(last=False)
+            print("dropped cached model", dropped)
+        return detector
@@ -0,0 +1,48 @@
+from collections import deque
+from dataclasses import fields
+
+import numpy as np
+
+from .schemas import FrameTimes
+
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyStats:
+    """Rolling percentiles of the time frames spend in each stage
+
+    A stage takes from the previous timestamp of a frame to its own, in
+    milliseconds. Stages a frame skipped are left out, their time counts
+    towards the next stage. `total` is from reading to the last timestamp.
+    Only the last `window` frames are kept.
+    """
+
+    def __init__(self, window: int = 1000):
+        names = [f.name for f in fields(FrameTimes)] + ["total"]
+        self.samples: dict[str, deque[float]] = {
+            name: deque(maxlen=window) for name in names
+        }
+
+    def add(self, times: FrameTimes):
+        first = 0.0
+        prev = 0.0
+        for f in fields(FrameTimes):
+            t: float = getattr(times, f.name)
+            if t <= 0:
+                continue
+            if prev > 0:
+                self.samples[f.name].append((t - prev) * 1000)
+            else:
+                first = t
+            prev = t
+        if prev > first:
+            self.samples["total"].append((prev - first) * 1000)
+
+    def percentiles(self) -> dict[str, tuple[float, float, float]]:
+        """p50, p95 and p99 of each stage with samples"""
+        res: dict[str, tuple[float, float, float]] = {}
+        for name, samples in self.samples.items():
+            if samples:
+                p50, p95, p99 = np.percentile(samples, PERCENTILES).tolist()
+                res[name] = (p50, p95, p99)
+        return res
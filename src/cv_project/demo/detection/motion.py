@@ -0,0 +1,46 @@
+import numpy as np
+from numpy.typing import NDArray
+
+from ..utils import Img
+
+# Width of the thumbnails which are compared
+THUMBNAIL_WIDTH = 64
+
+
+def thumbnail(img: Img) -> NDArray[np.float32]:
+    """Grayscale `img`, sampled down to about `THUMBNAIL_WIDTH` pixels wide"""
+    step = max(1, img.shape[1] // THUMBNAIL_WIDTH)
+    return img[::step, ::step].mean(axis=2, dtype=np.float32)
+
+
+class MotionGate:
+    """Decides whether a frame changed enough to be detected again
+
+    Frames are compared with the last frame which passed, by the mean absolute
+    difference of their thumbnails in gray levels (0 to 255). Frames within
+    `threshold` are skipped, at most `max_skips` in a row.
+    """
+
+    def __init__(self, threshold: float, max_skips: int):
+        self.threshold: float = threshold
+        self.max_skips: int = max_skips
+        self.reference: NDArray[np.float32] | None = None
+        # Frames skipped since the last which passed
+        self.skipped: int = 0
+        # Frames skipped in total
+        self.skips: int = 0
+
+    def changed(self, img: Img) -> bool:
+        small = thumbnail(img)
+        if (
+            self.reference is None
+            or self.skipped >= self.max_skips
+            or float(np.abs(small - self.reference).mean()) > self.threshold
+        ):
+            self.reference = small
+            self.skipped = 0
+            return True
+
+        self.skipped += 1
+        self.skips += 1
+        return False
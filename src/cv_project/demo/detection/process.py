@@ -1,75 +1,151 @@
+import time
 import traceback
-from dataclasses import dataclass
-from multiprocessing.connection import Connection
-from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import chain, zip_longest
+from multiprocessing import Pipe
+from multiprocessing.connection import Connection, wait
+from typing import cast
 
 import numpy as np
-from ultralytics import YOLO
-from ultralytics.engine.model import Model
 
+from ...tiling import merge_boxes
 from ..utils import Img
-from .process_utils import Source, mk_source
+from .detection_cache import DetectionCache
+from .detector import Detector, ModelCache, limit_threads
+from .motion import MotionGate
+from .process_utils import Source, VideoSource, mk_source
+from .regions import Region
+from .resolution import ImgSize, Resolution
+from .ring import ImageObj, Ring
 from .schemas import (
     Cmd,
+    CmdAckFrame,
+    CmdCloseSrc,
     CmdGetFrame,
+    CmdGetStats,
     CmdReply,
     CmdSetModel,
     CmdSetSrc,
+    CmdSetThreads,
+    CmdStartStream,
+    CmdStopStream,
     CmdTerminate,
-    DetectedObject,
-    Klass,
+    Detections,
     MsgTerminated,
     ReplyGetFrame,
+    ReplyGetStats,
     ReplySetModel,
     ReplySetSrc,
+    rect_roi,
 )
+from .tracking import Boxes, Tracker, Tracks, untracked
 
 
 @dataclass
-class ImageObj:
-    shm: SharedMemory
-    img: Img
-    ready: bool
-    prepared: ReplyGetFrame
+class Stream:
+    """A source attached to the processor, with its own images and tracks"""
+
+    ring: Ring
+    # None without tracking
+    tracker: Tracker | None
+    batch: int
+    keyframe_interval: int = 1
+    adaptive_keyframes: bool = False
+    # Frames since the last detected one, -1 before the first
+    since_keyframe: int = -1
+    # Parts of the frame which are detected, all of it if empty
+    regions: list[Region] = field(default_factory=list)
+    # Skips static frames, None to detect all
+    gate: MotionGate | None = None
+    # Objects of the last frame and whether they were predicted, static
+    # frames keep them
+    last_tracks: Tracks = field(
+        default_factory=lambda: np.empty((0, 7), dtype=np.float32)
+    )
+    last_predicted: bool = False
+    resolution: Resolution = field(default_factory=Resolution)
+    # Input size the last detected frame was detected at
+    imgsz: ImgSize = (0, 0)
+    # Boxes found in earlier runs over the same video
+    cache: DetectionCache | None = None
+
+    failing: bool = False
+    streaming: bool = False
+    credits: int = 0
+    # Frames asked for with `CmdGetFrame` which were not sent yet
+    requested: int = 0
+
+    def tiles(self):
+        return sum(len(r.tiles) for r in self.regions) or 1
+
+
+@dataclass
+class Detected:
+    """Objects found in a frame"""
+
+    boxes: Boxes
+    # Time the model took for all images of the frame, in milliseconds
+    latency: float
+    imgsz: ImgSize
+
+
+# Predictions which may be off by more than this, relative to the height of
+# an object, trigger detection with `adaptive_keyframes`
+MAX_DRIFT = 0.5
+
+
+def target_ms(msg: CmdSetSrc):
+    """Time the model may take per frame of the source, 0 if any"""
+    targets = [1000 / msg.target_fps if msg.target_fps > 0 else 0.0, msg.target_latency]
+    return min((t for t in targets if t > 0), default=0.0)
 
 
 class Processor:
+    """Detects objects in the frames of all sources with a single model
+
+    Frames of different sources are detected in the same batch, taking
+    turns between sources.
+    """
+
     def __init__(self, conn: Connection):
         self.conn: Connection = conn
 
-        self.model: Model | None = None
-        self.src: Source | None = None
-        self.images: list[ImageObj] = []
+        self.model: Detector | None = None
+        # See `CmdSetThreads`
+        self.threads: int = 0
+        self.models: ModelCache = ModelCache()
+        # Models are loaded in the background, `CmdSetModel` is replied to
+        # once they are ready
+        self.model_loader: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1)
+        self.model_loads: list[Future[Detector]] = []
+        self.streams: dict[int, Stream] = {}
 
-        self.prev_img: int = -1
-        self.sent_img: int = -1
         self.unknown_id_count: int = -1
-        self.failing: bool = False
 
-    def next_img(self, idx: int):
-        res = idx + 1
-        if res == len(self.images):
-            return 0
-        assert res >= 0 and res < len(self.images)
-        return res
+        # The capture thread wakes up `run` through this pipe
+        wakeup_recv, wakeup_send = Pipe(duplex=False)
+        self.wakeup_recv: Connection = cast(Connection, cast(object, wakeup_recv))
+        self.wakeup_send: Connection = cast(Connection, cast(object, wakeup_send))
+
+    def wakeup(self):
+        self.wakeup_send.send_bytes(b"")
 
     def run(self):
         while True:
-            if self.conn.poll(0):
-                msg = self.conn.recv()
-            else:
-                prepared = False
-                if not self.failing:
-                    for o in self.images:
-                        if not o.ready:
-                            # print("prepare")
-                            prepared = True
-                            self.prepare_ignore(o)
-                            break
-                if prepared:
+            if not self.conn.poll(0):
+                if self.finish_model_loads():
+                    continue
+                if self.push_frames():
+                    continue
+                if self.prepare_captured():
                     continue
                 # print("all frames ready")
-                msg = self.conn.recv()
+                _ = wait([self.conn, self.wakeup_recv])
+                while self.wakeup_recv.poll():
+                    _ = self.wakeup_recv.recv_bytes()
+                continue
+            msg = self.conn.recv()
 
             try:
                 resp = self.on_message(msg)
@@ -77,148 +153,440 @@ class Processor:
                 print("on_message failed", msg)
                 print(traceback.format_exc())
                 resp = self.on_failure(msg)
-            self.conn.send(resp)
+            if resp is not None:
+                self.conn.send(resp)
 
             if isinstance(resp, MsgTerminated):
                 return
 
-    def on_message(self, msg: Cmd) -> CmdReply:
+    def on_message(self, msg: Cmd) -> CmdReply | None:
         match msg:
             case CmdTerminate():
+                self.model_loader.shutdown(wait=False, cancel_futures=True)
                 return MsgTerminated()
             case CmdSetModel():
-                self.model = YOLO(msg.model_path)
-                return ReplySetModel(True)
+                load = self.model_loader.submit(
+                    self.models.get, msg.model_path, msg.backend
+                )
+                load.add_done_callback(lambda _: self.wakeup())
+                self.model_loads.append(load)
+                return None
+            case CmdSetThreads():
+                self.threads = msg.threads
+                backend = self.model.backend if self.model is not None else None
+                limit_threads(backend, self.threads)
+                return None
             case CmdSetSrc():
-                self.reset_source()
-
-                self.src = mk_source(msg.src_type, msg.src_value)
-                w, h = self.src.size()
-                shm_size = w * h * 3
-                shape = (h, w, 3)
-
-                names = list[str]()
-
-                for idx in range(3):
-                    shm = SharedMemory(create=True, size=shm_size)
-                    img: Img = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
-
-                    obj = ImageObj(shm, img, False, ReplyGetFrame(False, idx, []))
-                    self.images.append(obj)
-                    names.append(shm.name)
-                return ReplySetSrc(True, names, w, h)
+                self.reset_source(msg.src)
+
+                src = mk_source(msg.src_type, msg.src_value, msg.shard, msg.shards)
+                # Two images are held by the runner. By default the capture
+                # thread fills the next batch while the current one is detected.
+                depth = msg.depth if msg.depth > 0 else 2 * max(1, msg.batch) + 2
+                depth = max(3, depth)
+                batch = min(max(1, msg.batch), depth - 2)
+
+                ring = Ring(src, depth, msg.policy, self.wakeup, msg.src)
+                rois = msg.rois
+                if not rois and msg.tile_grid != (1, 1):
+                    rois = [rect_roi(0, 0, 1, 1)]
+                try:
+                    regions = [
+                        Region(
+                            roi,
+                            ring.width,
+                            ring.height,
+                            msg.tile_grid,
+                            msg.tile_overlap,
+                        )
+                        for roi in rois
+                    ]
+                    cache = self.open_cache(msg, src)
+                except Exception as exc:
+                    ring.close()
+                    raise exc
+                tracker = Tracker() if msg.track else None
+                gate = None
+                if msg.motion_threshold > 0:
+                    gate = MotionGate(msg.motion_threshold, msg.motion_max_skips)
+                self.streams[msg.src] = Stream(
+                    ring,
+                    tracker,
+                    batch,
+                    max(1, msg.keyframe_interval),
+                    msg.adaptive_keyframes,
+                    regions=regions,
+                    gate=gate,
+                    resolution=Resolution(msg.rect, target_ms(msg)),
+                    cache=cache,
+                )
+                ring.start()
+                return ReplySetSrc(True, ring.names(), ring.width, ring.height, msg.src)
+            case CmdCloseSrc():
+                self.reset_source(msg.src)
+                return None
             case CmdGetFrame():
                 assert self.model is not None
+                stream = self.streams[msg.src]
 
-                if self.prev_img != -1:
-                    o = self.images[self.prev_img]
-                    assert o.ready
-                    o.ready = False
-                if self.sent_img == -1:
-                    self.sent_img = 0
-                else:
-                    self.prev_img = self.sent_img
-                    self.sent_img = self.next_img(self.sent_img)
-                o = self.images[self.sent_img]
-
-                if not o.ready:
-                    self.prepare_raise(o)
-
-                return o.prepared
-
-    def on_failure(self, msg: Cmd) -> CmdReply:
+                # Answered by `push_frames` once a frame is detected
+                stream.requested += 1
+                return None
+            case CmdStartStream():
+                assert self.model is not None
+                stream = self.streams[msg.src]
+
+                stream.streaming = True
+                stream.credits = msg.credits
+                return None
+            case CmdAckFrame():
+                stream = self.streams[msg.src]
+
+                stream.ring.release(msg.idx)
+                stream.credits += 1
+                return None
+            case CmdStopStream():
+                if msg.src in self.streams:
+                    self.streams[msg.src].streaming = False
+                return ReplyGetFrame(False, -1, 0, msg.src)
+            case CmdGetStats():
+                if msg.src not in self.streams:
+                    return ReplyGetStats(True)
+                stream = self.streams[msg.src]
+                stats = stream.ring.stats()
+                if stream.gate is not None:
+                    stats.detect.skipped = stream.gate.skips
+                return stats
+
+    def on_failure(self, msg: Cmd) -> CmdReply | None:
         match msg:
             case CmdTerminate():
                 raise NotImplementedError()
             case CmdSetModel():
                 return ReplySetModel(False)
             case CmdSetSrc():
-                return ReplySetSrc(False, [], -1, -1)
-            case CmdGetFrame():
-                return ReplyGetFrame(False, -1, [])
+                return ReplySetSrc(False, [], -1, -1, msg.src)
+            case CmdGetFrame() | CmdStartStream() | CmdStopStream():
+                if msg.src in self.streams:
+                    self.streams[msg.src].streaming = False
+                return ReplyGetFrame(False, -1, 0, msg.src)
+            case CmdAckFrame() | CmdCloseSrc() | CmdSetThreads():
+                return None
+            case CmdGetStats():
+                return ReplyGetStats(False)
+
+    def open_cache(self, msg: CmdSetSrc, src: Source):
+        """Cache for the boxes of `src` if it is a video file"""
+        if not msg.cache_detections or not isinstance(src, VideoSource):
+            return None
+        # Sizes picked for a target depend on the load
+        if self.model is None or target_ms(msg) > 0:
+            return None
+        settings: dict[str, object] = {
+            "backend": self.model.backend,
+            "rois": msg.rois,
+            "tile_grid": msg.tile_grid,
+            "tile_overlap": msg.tile_overlap,
+            "rect": msg.rect,
+        }
+        return DetectionCache(src.path, self.model.model_path, settings)
+
+    def reset_source(self, src: int | None = None):
+        """Close the source `src`, or all of them"""
+        keys = list(self.streams) if src is None else [src]
+        for key in keys:
+            stream = self.streams.pop(key, None)
+            if stream is not None:
+                stream.ring.close()
+                if stream.cache is not None:
+                    stream.cache.flush()
+
+    def finish_model_loads(self):
+        """Switch to loaded models and reply to their `CmdSetModel`, in order
+
+        Returns False if there was nothing to do.
+        """
+        finished = False
+        while self.model_loads and self.model_loads[0].done():
+            load = self.model_loads.pop(0)
+            try:
+                model = load.result()
+                ok = True
+            except Exception:
+                print("loading model failed")
+                print(traceback.format_exc())
+                ok = False
+            else:
+                if model is not self.model:
+                    # Cached boxes are those of the old model
+                    for stream in self.streams.values():
+                        if stream.cache is not None:
+                            stream.cache.flush()
+                            stream.cache = None
+                self.model = model
+                if self.threads > 0:
+                    limit_threads(model.backend, self.threads)
+            self.conn.send(ReplySetModel(ok))
+            finished = True
+        return finished
+
+    def push_frames(self):
+        """Send detected frames which were requested, or while the runner has
+        credits left
+
+        Returns False if there was nothing to do.
+        """
+        pushed = False
+        for key, stream in self.streams.items():
+            while stream.requested > 0 or (stream.streaming and stream.credits > 0):
+                o = stream.ring.next_ready()
+                if o is None:
+                    # Frames which were not detected yet never will be when failing
+                    if stream.ring.ended() or stream.failing:
+                        print(key, "no frames left: stopping stream")
+                        # Every request gets a reply
+                        for _ in range(stream.requested):
+                            self.conn.send(ReplyGetFrame(False, -1, 0, key))
+                        stream.requested = 0
+                        if stream.streaming:
+                            self.conn.send(ReplyGetFrame(False, -1, 0, key))
+                            stream.streaming = False
+                    break
+                o.prepared.times.sent = time.monotonic()
+                self.conn.send(o.prepared)
+                if stream.requested > 0:
+                    stream.requested -= 1
+                else:
+                    stream.credits -= 1
+                pushed = True
+        return pushed
 
-    def reset_source(self):
-        if self.src is None:
-            return
+    def prepare_captured(self):
+        """Detect objects in captured frames of all sources
 
-        for o in self.images:
-            o.shm.close()
-            o.shm.unlink()
-        self.images = []
+        Each source waits for a full batch as long as it has prepared frames
+        to send. Once one source has a batch, the others join with the frames
+        they have. Returns False if there was nothing to do.
+        """
+        streams = [s for s in self.streams.values() if not s.failing]
 
-        self.sent_img = -1
-        self.prev_img = -1
-        self.failing = False
+        taken = [s.ring.take_captured(s.batch, wait_for_batch=True) for s in streams]
+        if not any(taken):
+            return False
+        for i, s in enumerate(streams):
+            if not taken[i]:
+                taken[i] = s.ring.take_captured(s.batch, wait_for_batch=False)
 
-        self.src.close()
-        self.src = None
+        # Round-robin, so that each source's frames stay in capture order
+        objs = [o for o in chain(*zip_longest(*taken)) if o is not None]
+        self.prepare_ignore(objs)
+        return True
 
-    def prepare_ignore(self, o: ImageObj):
+    def prepare_ignore(self, objs: list[ImageObj]):
         try:
-            self.prepare_raise(o)
+            self.prepare_raise(objs)
         except Exception as exc:
             print(exc)
             pass
 
-    def prepare_raise(self, o: ImageObj):
-        if self.failing:
-            raise RuntimeError("self.failing is set")
+    def stream_of(self, o: ImageObj):
+        return self.streams[o.prepared.src]
+
+    def detected(self, objs: list[ImageObj], ok: bool):
+        for o in objs:
+            self.stream_of(o).ring.detected([o], ok)
+
+    def prepare_raise(self, objs: list[ImageObj]):
+        if any(self.stream_of(o).failing for o in objs):
+            self.detected(objs, ok=False)
+            raise RuntimeError("stream.failing is set")
 
         try:
-            ok = self.prepare_optimistic(o)
+            self.prepare_optimistic(objs)
         except Exception as exc:
-            self.failing = True
+            for o in objs:
+                self.stream_of(o).failing = True
+            self.detected(objs, ok=False)
             raise exc
-        if not ok:
-            self.failing = True
-            raise RuntimeError()
+        self.detected(objs, ok=True)
+
+    def keyframes(self, objs: list[ImageObj]):
+        """Which of `objs` are detected, the others get predicted tracks
+
+        Adaptive keyframes are decided with the tracks known before `objs`,
+        so after a keyframe in `objs` the interval of its source is used.
+        """
+        res: list[bool] = []
+        since: dict[int, int] = {}
+        for o in objs:
+            stream = self.stream_of(o)
+            src = o.prepared.src
+            prev = since.get(src, stream.since_keyframe)
+            if stream.tracker is None or prev < 0:
+                key = True
+            else:
+                key = prev + 1 >= stream.keyframe_interval
+                if not key and stream.adaptive_keyframes and src not in since:
+                    _, drift = stream.tracker.predicted(stream.tracker.skipped + 1)
+                    key = drift > MAX_DRIFT
+            since[src] = 0 if key else prev + 1
+            res.append(key)
+        return res
 
-    def prepare_optimistic(self, o: ImageObj):
-        assert self.src is not None
+    def detect(self, objs: list[ImageObj]) -> list[Detected]:
+        """Objects in `objs`, taken from the cache of their source if it has them"""
+        cached: list[Detected | None] = []
+        for o in objs:
+            stream = self.stream_of(o)
+            boxes = None if stream.cache is None else stream.cache.get(o.prepared.frame)
+            cached.append(None if boxes is None else Detected(boxes, 0.0, stream.imgsz))
+
+        missing = [o for o, c in zip(objs, cached) if c is None]
+        inferred = self.infer(missing)
+        for o, detected in zip(missing, inferred):
+            cache = self.stream_of(o).cache
+            if cache is not None:
+                cache.put(o.prepared.frame, detected.boxes)
+
+        results = iter(inferred)
+        return [next(results) if c is None else c for c in cached]
+
+    def infer(self, objs: list[ImageObj]) -> list[Detected]:
+        """Run the model on `objs`, only in the regions of their source
+
+        Images are detected at once, unless their sources need different
+        input sizes.
+        """
         assert self.model is not None
-        assert not o.ready
-
-        ok = self.src.read(o.img)
-        if not ok:
-            print("no frame read")
-            return False
 
-        results = self.model.track(
-            o.img,
-            persist=True,
-            show=False,
-            verbose=False,
-            tracker="bytetrack.yaml",
-        )
-
-        objects = list[DetectedObject]()
-
-        if results[0].boxes:
-            for box in results[0].boxes:
-                if box.id is None:
-                    self.unknown_id_count += 1
-                    id = -self.unknown_id_count
-                else:
-                    id = int(box.id[0])
+        imgs: list[Img] = []
+        sizes: list[ImgSize] = []
+        for o in objs:
+            stream = self.stream_of(o)
+            regions = stream.regions
+            crops = [c for r in regions for c in r.crops(o.img)] or [o.img]
+            imgs.extend(crops)
+            sizes.extend(stream.resolution.imgsz(c.shape[1], c.shape[0]) for c in crops)
+
+        now = time.monotonic()
+        for o in objs:
+            o.prepared.times.preprocessed = now
+
+        by_size: dict[ImgSize, list[int]] = {}
+        for i, size in enumerate(sizes):
+            by_size.setdefault(size, []).append(i)
+        found: list[Boxes] = [np.empty((0, 6), dtype=np.float32)] * len(imgs)
+        latencies = [0.0] * len(imgs)
+        for size, idxs in by_size.items():
+            boxes = self.model.predict([imgs[i] for i in idxs], size)
+            for i, b in zip(idxs, boxes):
+                found[i] = b
+                latencies[i] = self.model.latency
+        now = time.monotonic()
+        for o in objs:
+            o.prepared.times.inferred = now
+
+        res: list[Detected] = []
+        start = 0
+        for o in objs:
+            stream = self.stream_of(o)
+            end = start + stream.tiles()
+            latency = sum(latencies[start:end])
+            if not stream.regions:
+                res.append(Detected(found[start], latency, sizes[start]))
+                start = end
+                continue
+
+            results = iter(found[start:end])
+            mapped = [
+                r.to_frame([next(results) for _ in r.tiles]) for r in stream.regions
+            ]
+            boxes = np.concatenate([b for b, _ in mapped])
+            # Objects in overlapping tiles or regions are detected repeatedly
+            if stream.tiles() > 1:
+                # Tiles numbered across regions
+                firsts = np.cumsum([0] + [len(r.tiles) for r in stream.regions])
+                tiles = np.concatenate([t + f for (_, t), f in zip(mapped, firsts)])
+                boxes = merge_boxes(boxes, tiles)
+            res.append(Detected(boxes, latency, sizes[start]))
+            start = end
+        return res
 
-                x1, y1, x2, y2 = map(int, box.xyxy[0])
+    def static(self, objs: list[ImageObj]):
+        """Which of `objs` keep the objects of the frame before, in frame order"""
+        res: list[bool] = []
+        for o in objs:
+            gate = self.stream_of(o).gate
+            res.append(gate is not None and not gate.changed(o.img))
+        return res
 
-                klass = int(box.cls[0])
-                if klass > 1:
-                    continue
+    def prepare_optimistic(self, objs: list[ImageObj]):
+        """Detect objects in the keyframes of `objs` at once
 
-                obj = DetectedObject(
-                    id=int(id),
-                    klass=Klass(klass),
-                    confidence=(float(box.conf[0])),
-                    x1=x1,
-                    y1=y1,
-                    x2=x2,
-                    y2=y2,
-                )
-                objects.append(obj)
+        Static frames keep the objects of the frame before them, without
+        being counted as frames by the tracker.
+        """
+        assert self.model is not None
 
-        o.ready = True
-        o.prepared.ok = True
-        o.prepared.objects = objects
-        return True
+        static = self.static(objs)
+        moving = iter(self.keyframes([o for o, s in zip(objs, static) if not s]))
+        keyframes = [not s and next(moving) for s in static]
+        results = iter(self.detect([o for o, key in zip(objs, keyframes) if key]))
+
+        # Tracker updates must be applied in frame order
+        for o, still, key in zip(objs, static, keyframes):
+            stream = self.stream_of(o)
+            tracker = stream.tracker
+            o.prepared.latency = 0.0
+            if still:
+                tracks = stream.last_tracks
+            elif not key:
+                assert tracker is not None
+                tracks = tracker.skip()
+                stream.since_keyframe += 1
+            else:
+                detected = next(results)
+                if tracker is None:
+                    tracks = untracked(detected.boxes)
+                else:
+                    tracks = tracker.update(detected.boxes, o.img)
+                stream.since_keyframe = 0
+                stream.resolution.update(detected.latency)
+                stream.imgsz = detected.imgsz
+                o.prepared.latency = detected.latency
+
+            if not still:
+                stream.last_tracks = tracks
+                stream.last_predicted = not key
+
+            o.prepared.times.tracked = time.monotonic()
+            o.prepared.ok = True
+            o.prepared.tiles = stream.tiles()
+            o.prepared.imgsz = stream.imgsz
+            o.prepared.count = self.store_detections(
+                tracks, o.detections, predicted=stream.last_predicted
+            )
+
+    def store_detections(self, tracks: Tracks, out: Detections, predicted: bool):
+        """Write chickens and eggs of `tracks` to `out`, returns their count"""
+        tracks = tracks[tracks[:, 6] <= 1]
+        if len(tracks) > len(out):
+            print("too many objects", len(tracks))
+            tracks = tracks[: len(out)]
+        count = len(tracks)
+
+        ids = tracks[:, 4].astype(np.int32)
+        unknown = ids < 0
+        n_unknown = int(unknown.sum())
+        ids[unknown] = -(self.unknown_id_count + 1 + np.arange(n_unknown))
+        self.unknown_id_count += n_unknown
+
+        out["id"][:count] = ids
+        out["klass"][:count] = tracks[:, 6]
+        out["confidence"][:count] = tracks[:, 5]
+        out["x1"][:count] = tracks[:, 0]
+        out["y1"][:count] = tracks[:, 1]
+        out["x2"][:count] = tracks[:, 2]
+        out["y2"][:count] = tracks[:, 3]
+        out["predicted"][:count] = predicted
+        return count
@@ -19,6 +19,10 @@ class Source(ABC):
 
     def size(self) -> tuple[int, int]: ...
 
+    def position(self) -> int:
+        """Number of the last frame read, counting from 0"""
+        ...
+
 
 class CameraSource(Source):
     def __init__(self, spec: str):
@@ -29,11 +33,15 @@ class CameraSource(Source):
         _ = self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, w)
         _ = self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, h)
 
+        self.frame_count: int = 0
+
         print("CameraSource fps", self.cap.get(cv2.CAP_PROP_FPS))
 
     @override
     def read(self, img: Img) -> bool:
         ok, _ = self.cap.read(img)
+        if ok:
+            self.frame_count += 1
         return ok
 
     @override
@@ -46,11 +54,24 @@ class CameraSource(Source):
         h = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         return w, h
 
+    @override
+    def position(self):
+        return self.frame_count - 1
+
 
 class VideoSource(Source):
-    def __init__(self, path: str):
+    """Frames of a video file, in real time
+
+    With `shards` > 1 only every `shards`-th frame is read, starting at
+    frame `shard`, so that several processes can split a video.
+    """
+
+    def __init__(self, path: str, shard: int = 0, shards: int = 1):
         print("VideoSource from", path)
+        self.path: str = path
         self.cap: cv2.VideoCapture = cv2.VideoCapture(path)
+        self.shard: int = shard
+        self.shards: int = shards
 
         self.frame_count: int = 0
         self.start_time: int = -1
@@ -72,9 +93,17 @@ class VideoSource(Source):
     def ts(self):
         return self.cur_ts - self.start_ts
 
+    def read_next(self, img: Img) -> bool:
+        skip = self.shard if self.frame_count == 0 else self.shards - 1
+        for _ in range(skip):
+            if not self.cap.grab():
+                return False
+        ok, _ = self.cap.read(img)
+        return ok
+
     @override
     def read(self, img: Img) -> bool:
-        ok, _ = self.cap.read(img)
+        ok = self.read_next(img)
         if not ok:
             return False
         self.frame_count += 1
@@ -92,7 +121,7 @@ class VideoSource(Source):
             # Skip late images
             while self.ts() < self.time():
                 # print("skip late image", self.ts(), self.time())
-                ok, _ = self.cap.read(img)
+                ok = self.read_next(img)
                 if not ok:
                     return False
                 self.upd_ts()
@@ -113,6 +142,10 @@ class VideoSource(Source):
         h = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         return w, h
 
+    @override
+    def position(self):
+        return int(self.cap.get(cv2.CAP_PROP_POS_FRAMES)) - 1
+
 
 class ImageSource(Source):
     def __init__(self, path: str):
@@ -129,17 +162,130 @@ class ImageSource(Source):
         np.copyto(img, self.img)
         return True
 
+    @override
+    def position(self):
+        return 0
+
+
+# Blobs drawn by `SyntheticSource`
+SYNTHETIC_CHICKENS = 3
+SYNTHETIC_EGGS = 6
+
+
+def bounce(x: np.ndarray, length: np.ndarray) -> np.ndarray:
+    """Position on 0..`length` of a point moving to `x`, reflected at the ends"""
+    return length - np.abs(np.mod(x, 2 * length) - length)
+
+
+class SyntheticSource(Source):
+    """Chicken- and egg-like blobs moving over a floor, drawn at a fixed rate
+
+    `spec` is `WxH@FPS`, optionally followed by `:SEED` and `:FRAMES`, e.g.
+    `640x360@30:1:900`. Without a number of frames it never ends. Frames only
+    depend on `spec` and their number, so that the source can be split like
+    a `VideoSource`.
+    """
+
+    def __init__(self, spec: str, shard: int = 0, shards: int = 1):
+        size, _, rest = spec.partition("@")
+        self.w: int
+        self.h: int
+        self.w, self.h = map(int, size.split("x"))
+        parts = rest.split(":")
+        self.fps: float = float(parts[0]) if parts[0] else 30.0
+        seed = int(parts[1]) if len(parts) > 1 else 0
+        self.frames: int = int(parts[2]) if len(parts) > 2 else 0
+        self.shard: int = shard
+        self.shards: int = shards
+
+        rng = np.random.default_rng(seed)
+        floor = np.full((self.h, self.w, 3), (70, 100, 120), dtype=np.float32)
+        floor += rng.normal(0, 12, size=floor.shape)
+        self.floor: Img = cv2.GaussianBlur(
+            floor.clip(0, 255).astype(np.uint8), (5, 5), 0
+        )
+
+        bounds = np.array([self.w, self.h], dtype=np.float64)
+        n = SYNTHETIC_CHICKENS + SYNTHETIC_EGGS
+        self.axes: np.ndarray = np.concatenate(
+            [
+                rng.uniform(0.06, 0.1, (SYNTHETIC_CHICKENS, 1)) * self.h * [1.3, 1.0],
+                rng.uniform(0.02, 0.03, (SYNTHETIC_EGGS, 1)) * self.h * [0.8, 1.0],
+            ]
+        )
+        # Blobs stay inside the frame
+        self.lengths: np.ndarray = np.maximum(bounds - 2 * self.axes, 1)
+        self.starts: np.ndarray = rng.uniform(0, 1, (n, 2)) * self.lengths
+        # In frame widths per second, eggs roll slowly
+        speeds = np.concatenate(
+            [np.full(SYNTHETIC_CHICKENS, 0.25), np.full(SYNTHETIC_EGGS, 0.03)]
+        )
+        angles = rng.uniform(0, 2 * np.pi, n)
+        self.velocities: np.ndarray = (
+            np.stack([np.cos(angles), np.sin(angles)], axis=1)
+            * (speeds * self.w)[:, None]
+        )
+        chicken_colors = [(235, 240, 245), (40, 80, 150)]
+        self.colors: list[tuple[int, int, int]] = [
+            chicken_colors[int(i)] for i in rng.integers(0, 2, SYNTHETIC_CHICKENS)
+        ] + [(190, 215, 235)] * SYNTHETIC_EGGS
+
+        self.next_frame: int = shard
+        self.frame: int = -1
+        self.start_time: float = -1.0
+
+    @override
+    def read(self, img: Img) -> bool:
+        idx = self.next_frame
+        if self.frames > 0 and idx >= self.frames:
+            return False
+
+        now = time.monotonic()
+        if self.start_time < 0:
+            self.start_time = now - self.shard / self.fps
+        due = self.start_time + idx / self.fps
+        if now < due:
+            time.sleep(due - now)
+
+        t = idx / self.fps
+        centers = self.axes + bounce(self.starts + self.velocities * t, self.lengths)
+        np.copyto(img, self.floor)
+        for i, ((x, y), (a, b), color) in enumerate(
+            zip(centers.astype(int), self.axes.astype(int), self.colors)
+        ):
+            _ = cv2.ellipse(img, (x, y), (a, b), 0, 0, 360, color, -1)
+            if i < SYNTHETIC_CHICKENS:
+                # Comb
+                _ = cv2.circle(img, (x, y - b), max(2, b // 4), (40, 40, 200), -1)
+
+        self.frame = idx
+        self.next_frame += self.shards
+        return True
+
+    @override
+    def size(self):
+        return self.w, self.h
+
+    @override
+    def position(self):
+        return self.frame
+
+
+def mk_source(typ: str, val: str, shard: int = 0, shards: int = 1) -> Source:
+    if shards > 1 and typ not in ("video", "video_url", "synthetic"):
+        raise RuntimeError("only videos can be split", typ, val)
 
-def mk_source(typ: str, val: str) -> Source:
     match typ:
         case "camera":
             return CameraSource(val)
         case "video":
-            return VideoSource(val)
+            return VideoSource(val, shard, shards)
         case "image":
             return ImageSource(val)
         case "video_url":
             path = make(f"download_video_sample('{val}')/'video.mp4'")
-            return VideoSource(str(path))
+            return VideoSource(str(path), shard, shards)
+        case "synthetic":
+            return SyntheticSource(val, shard, shards)
         case _:
             raise RuntimeError("unknown src type", typ, val)
@@ -0,0 +1,65 @@
+import cv2
+import numpy as np
+from numpy.typing import NDArray
+
+from ...tiling import Rect, tile_rects
+from ..utils import Img
+from .schemas import Roi
+from .tracking import Boxes
+
+
+class Region:
+    """A part of the frame which is detected on its own
+
+    The bounding rectangle of the polygon is detected, split into a `grid`
+    of overlapping tiles. Boxes are kept if their center is inside the
+    polygon.
+    """
+
+    def __init__(
+        self,
+        roi: Roi,
+        width: int,
+        height: int,
+        grid: tuple[int, int] = (1, 1),
+        overlap: float = 0.2,
+    ):
+        points = np.round(np.array(roi) * (width, height)).astype(np.int32)
+        x1, y1 = np.clip(points.min(axis=0), 0, (width, height))
+        x2, y2 = np.clip(points.max(axis=0) + 1, 0, (width, height))
+        if x2 <= x1 or y2 <= y1:
+            raise ValueError("empty region", roi)
+        self.x1: int = int(x1)
+        self.y1: int = int(y1)
+        self.x2: int = int(x2)
+        self.y2: int = int(y2)
+
+        self.mask: NDArray[np.uint8] = np.zeros(
+            (self.y2 - self.y1, self.x2 - self.x1), dtype=np.uint8
+        )
+        _ = cv2.fillPoly(self.mask, [points - (self.x1, self.y1)], 1)
+
+        self.tiles: list[Rect] = tile_rects(
+            (self.x1, self.y1, self.x2, self.y2), grid, overlap
+        )
+
+    def crops(self, img: Img) -> list[Img]:
+        return [img[y1:y2, x1:x2] for x1, y1, x2, y2 in self.tiles]
+
+    def to_frame(self, boxes: list[Boxes]) -> tuple[Boxes, NDArray[np.int64]]:
+        """Map `boxes` detected in each of the `crops` to the frame
+
+        Also returns the index of the tile of each box.
+        """
+        mapped = [b.copy() for b in boxes]
+        for b, (x1, y1, _, _) in zip(mapped, self.tiles):
+            b[:, [0, 2]] += x1
+            b[:, [1, 3]] += y1
+        res = np.concatenate(mapped)
+        tiles = np.repeat(np.arange(len(mapped)), [len(b) for b in mapped])
+
+        h, w = self.mask.shape
+        cx = ((res[:, 0] + res[:, 2]) / 2 - self.x1).astype(np.int32).clip(0, w - 1)
+        cy = ((res[:, 1] + res[:, 3]) / 2 - self.y1).astype(np.int32).clip(0, h - 1)
+        inside = self.mask[cy, cx] > 0
+        return res[inside], tiles[inside]
@@ -0,0 +1,65 @@
+import math
+
+# Height and width of the model input
+ImgSize = tuple[int, int]
+
+# Sizes are multiples of the largest stride of YOLO models
+STRIDE = 32
+MIN_SIZE = 256
+MAX_SIZE = 1280
+DEFAULT_SIZE = 640
+
+# Sizes are picked for frames to take this fraction of the target time, and
+# kept while they take between it and the target
+HEADROOM = 0.8
+# Frames detected at a new size before it is judged
+SETTLE_FRAMES = 10
+
+
+def stride_ceil(x: float):
+    return max(STRIDE, math.ceil(x / STRIDE) * STRIDE)
+
+
+class Resolution:
+    """Size of the model input for the frames of a source
+
+    `size` is the longer side. With `rect`, the input has the aspect ratio
+    of the image instead of being square, so that little of it is padding.
+    With a `target_ms`, `size` is lowered while detecting a frame takes
+    longer than that and raised while it takes much less.
+    """
+
+    def __init__(self, rect: bool = False, target_ms: float = 0.0):
+        self.rect: bool = rect
+        self.target_ms: float = target_ms
+        self.size: int = DEFAULT_SIZE
+        # Moving average of the time per frame at `size`
+        self.avg_ms: float | None = None
+        self.frames: int = 0
+
+    def imgsz(self, width: int, height: int) -> ImgSize:
+        """Input size for an image of `width` by `height`"""
+        if not self.rect:
+            return self.size, self.size
+        scale = self.size / max(width, height)
+        return stride_ceil(height * scale), stride_ceil(width * scale)
+
+    def update(self, ms: float):
+        """Account for a frame detected at `size` which took `ms`"""
+        if self.target_ms <= 0:
+            return
+        self.avg_ms = ms if self.avg_ms is None else 0.8 * self.avg_ms + 0.2 * ms
+        self.frames += 1
+        if self.frames < SETTLE_FRAMES:
+            return
+        if HEADROOM * self.target_ms <= self.avg_ms <= self.target_ms:
+            return
+
+        # The time taken grows with the area of the input
+        size = self.size * math.sqrt(HEADROOM * self.target_ms / self.avg_ms)
+        size = min(MAX_SIZE, max(MIN_SIZE, round(size / STRIDE) * STRIDE))
+        if size != self.size:
+            print("inference size", self.size, "->", size)
+            self.size = size
+            self.avg_ms = None
+            self.frames = 0
@@ -0,0 +1,310 @@
+import threading
+import time
+import traceback
+from copy import copy
+from dataclasses import dataclass
+from enum import Enum
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable
+
+import numpy as np
+
+from ..utils import Img
+from .process_utils import Source
+from .schemas import (
+    DETECTION_DTYPE,
+    MAX_OBJECTS,
+    Detections,
+    DropPolicy,
+    FrameTimes,
+    ReplyGetFrame,
+    ReplyGetStats,
+    StageStats,
+    detections_offset,
+    shm_size,
+)
+
+
+class SlotState(Enum):
+    FREE = 0
+    CAPTURING = 1
+    CAPTURED = 2
+    DETECTING = 3
+    READY = 4
+
+
+@dataclass
+class ImageObj:
+    shm: SharedMemory
+    img: Img
+    detections: Detections
+    state: SlotState
+    prepared: ReplyGetFrame
+    # Capture order, -1 while the image holds no frame
+    seq: int = -1
+
+
+class Ring:
+    """Shared memory images, filled with frames of `src` by a capture thread
+
+    Frames are sent in capture order. Sent images are held by the runner
+    until released, all others are free or hold a frame which was not sent
+    yet.
+    When no image is free, `policy` decides whether the capture thread
+    waits or overwrites an unsent frame.
+    `src_id` is the number the runner gave to the source.
+    """
+
+    def __init__(
+        self,
+        src: Source,
+        depth: int,
+        policy: DropPolicy,
+        on_captured: Callable[[], None],
+        src_id: int = 0,
+    ):
+        assert depth >= 3
+        self.src: Source = src
+        self.policy: DropPolicy = policy
+        self.on_captured: Callable[[], None] = on_captured
+
+        self.width: int
+        self.height: int
+        self.width, self.height = src.size()
+        shape = (self.height, self.width, 3)
+        offset = detections_offset(self.width, self.height)
+
+        self.images: list[ImageObj] = []
+        for idx in range(depth):
+            shm = SharedMemory(create=True, size=shm_size(self.width, self.height))
+            img: Img = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            detections: Detections = np.ndarray(
+                (MAX_OBJECTS,), dtype=DETECTION_DTYPE, buffer=shm.buf, offset=offset
+            )
+
+            prepared = ReplyGetFrame(False, idx, 0, src_id)
+            obj = ImageObj(shm, img, detections, SlotState.FREE, prepared)
+            self.images.append(obj)
+
+        # Guards image states and everything below
+        self.cond: threading.Condition = threading.Condition()
+
+        # Images held by the runner, in the order they were sent
+        self.sent: list[int] = []
+
+        self.next_seq: int = 0
+        self.detect_stalled: bool = False
+        self.send_stalled: bool = False
+        self.capture_done: bool = False
+        self.stopping: bool = False
+        self.thread: threading.Thread = threading.Thread(
+            target=self.capture, daemon=True
+        )
+
+        self.capture_stats: StageStats = StageStats()
+        self.detect_stats: StageStats = StageStats()
+        self.send_stats: StageStats = StageStats()
+
+    def names(self):
+        return [o.shm.name for o in self.images]
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        if self.thread.is_alive():
+            self.thread.join()
+
+        # Views into shared memory must be gone before it can be closed
+        shms = [o.shm for o in self.images]
+        self.images = []
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+        self.src.close()
+
+    def stats(self):
+        with self.cond:
+            return ReplyGetStats(
+                True,
+                copy(self.capture_stats),
+                copy(self.detect_stats),
+                copy(self.send_stats),
+            )
+
+    def held(self):
+        return set(self.sent)
+
+    def unsent(self):
+        """Images with a frame which was not sent yet, in capture order"""
+        held = self.held()
+        res = [
+            o
+            for idx, o in enumerate(self.images)
+            if idx not in held and o.state in (SlotState.CAPTURED, SlotState.READY)
+        ]
+        return sorted(res, key=lambda o: o.seq)
+
+    def drop(self, o: ImageObj):
+        if o.state == SlotState.CAPTURED:
+            self.detect_stats.dropped += 1
+        else:
+            assert o.state == SlotState.READY
+            self.send_stats.dropped += 1
+        o.state = SlotState.FREE
+        o.seq = -1
+        self.cond.notify_all()
+
+    def capture_slot(self) -> ImageObj | None:
+        """Find an image to capture into, None if stopping"""
+        stalled = False
+        while not self.stopping:
+            for o in self.images:
+                if o.state == SlotState.FREE:
+                    return o
+
+            if self.policy != "block":
+                unsent = self.unsent()
+                if unsent:
+                    self.drop(unsent[0])
+                    return unsent[0]
+
+            if not stalled:
+                stalled = True
+                self.capture_stats.stalled += 1
+            _ = self.cond.wait()
+        return None
+
+    def capture(self):
+        while True:
+            with self.cond:
+                o = self.capture_slot()
+                if o is None:
+                    return
+                o.state = SlotState.CAPTURING
+
+            read = time.monotonic()
+            try:
+                ok = self.src.read(o.img)
+            except Exception:
+                print(traceback.format_exc())
+                ok = False
+
+            with self.cond:
+                if ok:
+                    o.seq = self.next_seq
+                    self.next_seq += 1
+                    o.prepared.frame = self.src.position()
+                    o.prepared.times = FrameTimes(read, time.monotonic())
+                    o.state = SlotState.CAPTURED
+                    self.capture_stats.frames += 1
+
+                    if self.policy == "latest_only":
+                        for old in self.unsent():
+                            if old is not o:
+                                self.drop(old)
+                else:
+                    print("no frame read")
+                    o.state = SlotState.FREE
+                    self.capture_done = True
+                self.cond.notify_all()
+
+            self.on_captured()
+            if not ok:
+                return
+
+    def ready_ahead(self):
+        """Number of detected frames which were not sent yet"""
+        return sum(1 for o in self.unsent() if o.state == SlotState.READY)
+
+    def take_captured(self, batch: int, wait_for_batch: bool):
+        """Mark up to `batch` captured images as being detected, in capture order
+
+        With `wait_for_batch`, returns nothing unless there is a full batch or
+        nothing else to send.
+        """
+        with self.cond:
+            captured = sorted(
+                (o for o in self.images if o.state == SlotState.CAPTURED),
+                key=lambda o: o.seq,
+            )
+
+            if captured:
+                self.detect_stalled = False
+            elif not self.detect_stalled and not self.capture_done:
+                self.detect_stalled = True
+                self.detect_stats.stalled += 1
+
+            if (
+                wait_for_batch
+                and len(captured) < batch
+                and self.ready_ahead() > 0
+                and not self.capture_done
+            ):
+                return []
+
+            res = captured[:batch]
+            for o in res:
+                o.state = SlotState.DETECTING
+            return res
+
+    def detected(self, objs: list[ImageObj], ok: bool):
+        with self.cond:
+            for o in objs:
+                assert o.state == SlotState.DETECTING
+                if ok:
+                    o.state = SlotState.READY
+                    self.detect_stats.frames += 1
+                else:
+                    o.state = SlotState.FREE
+                    o.seq = -1
+                    self.detect_stats.dropped += 1
+            self.cond.notify_all()
+
+    def release(self, idx: int):
+        with self.cond:
+            self.sent.remove(idx)
+            o = self.images[idx]
+            # Not ready if its detection failed
+            if o.state == SlotState.READY:
+                o.state = SlotState.FREE
+                o.seq = -1
+                self.cond.notify_all()
+
+    def pick(self, unsent: list[ImageObj]):
+        """Mark the next of the `unsent` images as sent"""
+        if self.policy == "latest_only":
+            for old in unsent[:-1]:
+                self.drop(old)
+        o = unsent[-1] if self.policy == "latest_only" else unsent[0]
+
+        self.sent.append(o.prepared.idx)
+        self.send_stats.frames += 1
+        return o
+
+    def next_ready(self) -> ImageObj | None:
+        """Pick the next frame to send if it was already detected"""
+        with self.cond:
+            unsent = self.unsent()
+            if self.policy == "latest_only":
+                ready = bool(unsent) and unsent[-1].state == SlotState.READY
+            else:
+                ready = bool(unsent) and unsent[0].state == SlotState.READY
+
+            if not ready:
+                if not self.send_stalled and not self.ended():
+                    self.send_stalled = True
+                    self.send_stats.stalled += 1
+                return None
+
+            self.send_stalled = False
+            return self.pick(unsent)
+
+    def ended(self):
+        """Whether all frames of the source were sent"""
+        with self.cond:
+            return self.capture_done and not self.unsent()
@@ -1,27 +1,45 @@
 import multiprocessing
-from dataclasses import dataclass
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
 from multiprocessing import Pipe
 from multiprocessing.connection import Connection
 from multiprocessing.shared_memory import SharedMemory
 from typing import Callable, cast, final
 
 import numpy as np
-from PySide6.QtCore import QObject, Qt, QThread, QTimer, Signal
+from PySide6.QtCore import QObject, QSocketNotifier, Qt, QThread, QTimer, Signal
 
 from ..utils import Img
+from .latency import LatencyStats
 from .schemas import (
+    DETECTION_DTYPE,
+    MAX_OBJECTS,
+    Backend,
     Cmd,
+    CmdAckFrame,
+    CmdCloseSrc,
     CmdGetFrame,
+    CmdGetStats,
     CmdReply,
     CmdSetModel,
     CmdSetSrc,
+    CmdSetThreads,
+    CmdStartStream,
+    CmdStopStream,
     CmdTerminate,
-    DetectedObject,
+    Detections,
+    DropPolicy,
+    FrameTimes,
     MsgTerminated,
     ReplyGetFrame,
+    ReplyGetStats,
     ReplySetModel,
     ReplySetSrc,
+    Roi,
     SrcType,
+    detections_offset,
 )
 
 
@@ -38,21 +56,35 @@ def run_detection(conn: Connection):
 @dataclass
 class PipeReply:
     content: CmdReply
+    # Detection process which sent the reply
+    worker: int = 0
 
 
 @final
 class MsgPipe(QObject):
+    """Talks to a detection process from its own thread
+
+    Commands are sent without waiting for their replies. Whatever the process
+    sends is read as soon as it arrives and emitted with `response_received`.
+    """
+
     response_received = Signal(PipeReply)
 
-    def __init__(self, pipe: Connection):
+    def __init__(self, pipe: Connection, worker: int = 0):
         super().__init__()
         _ = self.destroyed.connect(lambda: print("MsgPipe destroyed"))
 
         self.pipe = pipe
+        self.worker = worker
+        self.notifier: QSocketNotifier | None = None
 
     def send(self, obj: Cmd):
         QTimer.singleShot(0, self, lambda: self._send(obj))
 
+    def start_reading(self):
+        """Read messages once the thread of the pipe runs"""
+        QTimer.singleShot(0, self, self._start_reading)
+
     def _send(self, obj: Cmd):
         if self.pipe.closed:
             print("MsgPipe.send closed ", obj)
@@ -60,88 +92,308 @@ class MsgPipe(QObject):
 
         # print("PipeReader.send ", obj)
         self.pipe.send(obj)
-        self._recv()
+
+    def _start_reading(self):
+        self.notifier = QSocketNotifier(
+            self.pipe.fileno(), QSocketNotifier.Type.Read, self
+        )
+        _ = self.notifier.activated.connect(self._on_readable)
+
+    def _on_readable(self):
+        assert self.notifier is not None
+        try:
+            while not self.pipe.closed and self.pipe.poll():
+                self._recv()
+        except (EOFError, OSError):
+            print("MsgPipe: detection process is gone")
+            self.notifier.setEnabled(False)
 
     def _recv(self):
         obj = self.pipe.recv()
+        if isinstance(obj, ReplyGetFrame):
+            obj.times.received = time.monotonic()
         # print("PipeReader.recv ", obj)
-        self.response_received.emit(PipeReply(obj))
+        self.response_received.emit(PipeReply(obj, self.worker))
 
 
 @dataclass
 class NewFrame:
     img: Img
-    objects: list[DetectedObject]
+    # A view into shared memory, valid until the next frame is shown
+    objects: Detections
+    src: int = 0
+    # Time the model took for the frame, in milliseconds
+    latency: float = 0.0
+    # Images detected for the frame, see `CmdSetSrc.tile_grid`
+    tiles: int = 1
+    # Height and width of the model input
+    imgsz: tuple[int, int] = (0, 0)
+    # The receiver stamps `filtered` and `painted`, then passes them to
+    # `DetectionRunner.frame_done`
+    times: FrameTimes = field(default_factory=FrameTimes)
+
+
+@dataclass
+class Worker:
+    """A detection process, talked to from its own thread"""
+
+    process: multiprocessing.Process
+    pipe: MsgPipe
+    thread: QThread
+    # Threads the model may use, see `CmdSetThreads`
+    threads: int = 0
+
+
+@dataclass
+class Shard:
+    """The images of a source in one of the detection processes"""
+
+    worker: int
+    shm_images: list[SharedMemory]
+    images: list[Img]
+    detections: list[Detections]
+    # Whether frames are still expected
+    active: bool = False
+    # Frames received but not shown yet, in frame order
+    pending: deque[ReplyGetFrame] = field(default_factory=deque)
+    # Image shown by the GUI, acknowledged on the next frame of this shard
+    shown_idx: int = -1
+    # Frames requested with `CmdGetFrame` which did not arrive yet
+    requested: int = 0
+
+
+def sum_stats(replies: list[ReplyGetStats]):
+    res = ReplyGetStats(all(r.ok for r in replies))
+    for r in replies:
+        for total, stage in (
+            (res.capture, r.capture),
+            (res.detect, r.detect),
+            (res.send, r.send),
+        ):
+            total.frames += stage.frames
+            total.dropped += stage.dropped
+            total.stalled += stage.stalled
+            total.skipped += stage.skipped
+    return res
 
 
 @final
 class DetectionRunner(QObject):
+    """Runs detection in `workers` processes
+
+    Each source is detected by one of the processes, unless it is a video
+    which is split frame by frame across all of them. Frames of a split
+    video are shown in frame order.
+    """
+
     _model_updated = Signal(bool)
     _source_updated = Signal(bool)
+    _stats_received = Signal(ReplyGetStats)
     frames_started = Signal()
     frames_stopped = Signal()
     new_frame = Signal(NewFrame)
 
-    def __init__(self):
+    def __init__(self, workers: int = 1):
         super().__init__()
         _ = self.destroyed.connect(lambda: print("DetectionRunner destroyed"))
 
-        self.shm_images: list[SharedMemory] = []
-        self.images: list[Img] = []
+        # Images of each source, by source number
+        self.sources: dict[int, list[Shard]] = {}
         self.just_started = True
         self.request_frames = False
         self.requesting_frames = False
+        self.streaming = False
+        # Sources which did not stop sending frames yet
+        self.active: set[int] = set()
 
-        # Initialize a pipe
+        # Replies which are collected from several workers
+        self.model_replies: list[ReplySetModel] = []
+        self.src_workers: dict[int, list[int]] = {}
+        self.src_replies: dict[int, dict[int, ReplySetSrc]] = {}
+        self.stats_replies: list[ReplyGetStats] = []
+        self.stats_expected = 0
 
-        self.pipe_thread = QThread(self)
-        _ = self.pipe_thread.destroyed.connect(
-            lambda: print("DetectionRunner.pipe_thread destroyed")
-        )
+        self.latencies = LatencyStats()
 
-        here, there = Pipe()
-        self.pipe = MsgPipe(cast(Connection, cast(object, here)))
-        _ = self.pipe.moveToThread(self.pipe_thread)
+        self.workers: list[Worker] = []
+        for idx in range(max(1, workers)):
+            # Initialize a pipe
 
-        _ = self.pipe.response_received.connect(
-            self._on_response, Qt.ConnectionType.BlockingQueuedConnection
-        )
+            pipe_thread = QThread(self)
+            _ = pipe_thread.destroyed.connect(
+                lambda: print("DetectionRunner.pipe_thread destroyed")
+            )
 
-        # END Initialize a pipe
+            here, there = Pipe()
+            pipe = MsgPipe(cast(Connection, cast(object, here)), idx)
+            _ = pipe.moveToThread(pipe_thread)
 
-        self.process = multiprocessing.Process(target=run_detection, args=[there])
+            # Queued, so that the pipe thread keeps reading while the GUI is busy
+            _ = pipe.response_received.connect(
+                self._on_response, Qt.ConnectionType.QueuedConnection
+            )
 
-    def set_model(self, model: str, cb: Callable[[bool], None]):
-        _ = self._model_updated.connect(cb, Qt.ConnectionType.SingleShotConnection)
-        self.pipe.send(CmdSetModel(model))
+            # END Initialize a pipe
 
-    def set_source(self, src_type: SrcType, src_value: str, cb: Callable[[bool], None]):
+            process = multiprocessing.Process(target=run_detection, args=[there])
+            self.workers.append(Worker(process, pipe, pipe_thread))
+
+    def set_model(
+        self, model: str, cb: Callable[[bool], None], backend: Backend = "torch"
+    ):
+        _ = self._model_updated.connect(cb, Qt.ConnectionType.SingleShotConnection)
+        self.model_replies = []
+        for worker in self.workers:
+            worker.pipe.send(CmdSetModel(model, backend))
+
+    def set_source(
+        self,
+        src_type: SrcType,
+        src_value: str,
+        cb: Callable[[bool], None],
+        batch: int = 1,
+        depth: int = 0,
+        policy: DropPolicy = "block",
+        src: int = 0,
+        split_frames: bool = False,
+        keyframe_interval: int = 1,
+        adaptive_keyframes: bool = False,
+        rois: list[Roi] | None = None,
+        tile_grid: tuple[int, int] = (1, 1),
+        tile_overlap: float = 0.2,
+        motion_threshold: float = 0.0,
+        motion_max_skips: int = 30,
+        rect: bool = False,
+        target_fps: float = 0.0,
+        target_latency: float = 0.0,
+        cache_detections: bool = False,
+    ):
+        """Attach a source as number `src`, replacing the one with that number
+
+        With `split_frames`, a video is split across all workers. Its objects
+        are not tracked then, so every frame is detected.
+        """
         _ = self._source_updated.connect(cb, Qt.ConnectionType.SingleShotConnection)
-        self.pipe.send(CmdSetSrc(src_type, src_value))
 
-    def start_frames(self):
+        split = (
+            split_frames
+            and src_type in ("video", "video_url", "synthetic")
+            and len(self.workers) > 1
+        )
+        workers = list(range(len(self.workers))) if split else [src % len(self.workers)]
+
+        for idx in self.src_workers.get(src, []):
+            if idx not in workers:
+                self.workers[idx].pipe.send(CmdCloseSrc(src))
+        self.src_workers[src] = workers
+        self.src_replies[src] = {}
+        self._share_cores()
+
+        for shard, idx in enumerate(workers):
+            cmd = CmdSetSrc(
+                src_type,
+                src_value,
+                batch,
+                depth,
+                policy,
+                src,
+                track=not split,
+                shard=shard,
+                shards=len(workers),
+                keyframe_interval=keyframe_interval,
+                adaptive_keyframes=adaptive_keyframes,
+                rois=rois or [],
+                tile_grid=tile_grid,
+                tile_overlap=tile_overlap,
+                motion_threshold=motion_threshold,
+                motion_max_skips=motion_max_skips,
+                rect=rect,
+                target_fps=target_fps,
+                target_latency=target_latency,
+                cache_detections=cache_detections,
+            )
+            self.workers[idx].pipe.send(cmd)
+
+    def frame_done(self, times: FrameTimes):
+        """Account for a frame of `new_frame` which was shown"""
+        self.latencies.add(times)
+
+    def latency_percentiles(self):
+        """p50, p95 and p99 in milliseconds of each stage of recent frames"""
+        return self.latencies.percentiles()
+
+    def get_stats(self, cb: Callable[[ReplyGetStats], None], src: int = 0):
+        """Get the stats of `src`, summed over the workers it is split across"""
+        _ = self._stats_received.connect(cb, Qt.ConnectionType.SingleShotConnection)
+        workers = self.src_workers.get(src, [src % len(self.workers)])
+        self.stats_replies = []
+        self.stats_expected = len(workers)
+        for idx in workers:
+            self.workers[idx].pipe.send(CmdGetStats(src))
+
+    def start_frames(self, streaming: bool = False, credits: int = 2):
+        """Request frames, or let the detection process push them
+
+        Frames of all sources are received. Up to `credits` images of each
+        source are in flight or shown per worker, at least two as one of
+        them is shown while the next arrives.
+        """
         print("start_frames")
+        credits = max(2, credits)
         self.just_started = True
         self.request_frames = True
         self.requesting_frames = True
-        self.pipe.send(CmdGetFrame())
+        self.streaming = streaming
+        self.active = set(self.sources)
+        for src, shards in self.sources.items():
+            for shard in shards:
+                shard.active = True
+                self._drop_pending(shard, src)
+                if shard.shown_idx != -1:
+                    self._ack(shard, src, shard.shown_idx)
+                    shard.shown_idx = -1
+
+                if streaming:
+                    pipe = self.workers[shard.worker].pipe
+                    pipe.send(CmdStartStream(credits, src))
+                else:
+                    for _ in range(credits):
+                        self._request(shard, src)
 
     def stop_frames(self):
         self.request_frames = False
+        for src, shards in self.sources.items():
+            for shard in shards:
+                if not shard.active:
+                    continue
+                if self.streaming:
+                    pipe = self.workers[shard.worker].pipe
+                    pipe.send(CmdStopStream(src))
+                elif shard.requested == 0:
+                    self._drop_pending(shard, src)
+                    shard.active = False
+            if not self.streaming:
+                # Let the caller finish before frames_stopped is emitted
+                QTimer.singleShot(0, self, lambda src=src: self._show_frames(src))
 
     def start(self):
-        self.pipe_thread.start()
-        self.process.start()
+        for worker in self.workers:
+            worker.thread.start()
+            worker.pipe.start_reading()
+            worker.process.start()
 
     def stop(self):
-        _ = self.pipe.response_received.disconnect(self._on_response)
+        for worker in self.workers:
+            _ = worker.pipe.response_received.disconnect(self._on_response)
 
         self._reset_shm_image()
-        self.pipe.send(CmdTerminate())
-        self.process.join()
-        self.pipe.deleteLater()
-        self.pipe_thread.quit()
-        _ = self.pipe_thread.wait()
+        for worker in self.workers:
+            worker.pipe.send(CmdTerminate())
+        for worker in self.workers:
+            worker.process.join()
+            worker.pipe.deleteLater()
+            worker.thread.quit()
+            _ = worker.thread.wait()
         self.deleteLater()
 
     def _on_response(self, msg: PipeReply):
@@ -149,39 +401,170 @@ class DetectionRunner(QObject):
             case MsgTerminated():
                 assert False
             case ReplySetModel() as obj:
-                self._model_updated.emit(obj.ok)
+                self.model_replies.append(obj)
+                if len(self.model_replies) == len(self.workers):
+                    self._model_updated.emit(all(r.ok for r in self.model_replies))
             case ReplySetSrc() as obj:
-                self._reset_shm_image()
-                shape = (obj.height, obj.width, 3)
-                for name in obj.shm_names:
-                    shm_image = SharedMemory(name=name)
-                    image: Img = np.ndarray(shape, dtype=np.uint8, buffer=shm_image.buf)
-                    self.shm_images.append(shm_image)
-                    self.images.append(image)
-                self._source_updated.emit(obj.ok)
+                self.src_replies[obj.src][msg.worker] = obj
+                workers = self.src_workers[obj.src]
+                if len(self.src_replies[obj.src]) == len(workers):
+                    self._on_source_replies(obj.src)
+            case ReplyGetStats() as obj:
+                self.stats_replies.append(obj)
+                if len(self.stats_replies) == self.stats_expected:
+                    self._stats_received.emit(sum_stats(self.stats_replies))
             case ReplyGetFrame() as obj:
                 if self.just_started:
                     self.just_started = False
                     self.frames_started.emit()
 
+                shards = self.sources.get(obj.src, [])
+                shard = next((s for s in shards if s.worker == msg.worker), None)
+                if shard is None:
+                    print(obj.src, "frame of an unknown source")
+                    return
+                if not self.streaming:
+                    shard.requested -= 1
+
                 if not obj.ok:
-                    print("no frame: stopping requests")
-                    self.requesting_frames = False
-                    self.frames_stopped.emit()
+                    print(obj.src, "no frame: stopping requests")
+                    shard.active = False
+                    self._show_frames(obj.src)
                     return
 
                 if not self.request_frames:
-                    print("not self.request_frames: stopping requests")
-                    self.requesting_frames = False
-                    self.frames_stopped.emit()
+                    self._ack(shard, obj.src, obj.idx)
+                    if self.streaming or shard.requested > 0:
+                        # Waiting for the end of the stream or the frames
+                        # which were requested
+                        return
+                    print(obj.src, "not self.request_frames: stopping requests")
+                    shard.active = False
+                    self._show_frames(obj.src)
                     return
 
-                resp = NewFrame(self.images[obj.idx], obj.objects)
-                self.new_frame.emit(resp)
-                self.pipe.send(CmdGetFrame())
+                shard.pending.append(obj)
+                self._show_frames(obj.src)
+
+    def _share_cores(self):
+        """Split the cores between the workers which detect a source
+
+        Workers otherwise each use all of them and compete for the CPU.
+        """
+        busy = {idx for workers in self.src_workers.values() for idx in workers}
+        threads = max(1, (os.cpu_count() or 1) // max(1, len(busy)))
+        for idx in busy:
+            worker = self.workers[idx]
+            if worker.threads != threads:
+                worker.threads = threads
+                worker.pipe.send(CmdSetThreads(threads))
+
+    def _on_source_replies(self, src: int):
+        replies = self.src_replies.pop(src)
+        workers = self.src_workers[src]
+        ok = all(r.ok for r in replies.values())
+
+        self._reset_shm_image(src)
+        if not ok:
+            for idx, r in replies.items():
+                if r.ok:
+                    self.workers[idx].pipe.send(CmdCloseSrc(src))
+            _ = self.src_workers.pop(src)
+            self._share_cores()
+            self._source_updated.emit(False)
+            return
 
-    def _reset_shm_image(self):
-        while self.shm_images:
-            shm = self.shm_images.pop()
-            shm.close()
-        self.images = []
+        shards: list[Shard] = []
+        for idx in workers:
+            obj = replies[idx]
+            shard = Shard(idx, [], [], [])
+            shape = (obj.height, obj.width, 3)
+            offset = detections_offset(obj.width, obj.height)
+            for name in obj.shm_names:
+                shm_image = SharedMemory(name=name)
+                image: Img = np.ndarray(shape, dtype=np.uint8, buffer=shm_image.buf)
+                detections: Detections = np.ndarray(
+                    (MAX_OBJECTS,),
+                    dtype=DETECTION_DTYPE,
+                    buffer=shm_image.buf,
+                    offset=offset,
+                )
+                shard.shm_images.append(shm_image)
+                shard.images.append(image)
+                shard.detections.append(detections)
+            shards.append(shard)
+        self.sources[src] = shards
+        self._source_updated.emit(True)
+
+    def _show_frames(self, src: int):
+        """Show received frames of `src` in frame order
+
+        A frame is shown once every shard which still sends frames has one.
+        """
+        shards = self.sources.get(src, [])
+        while True:
+            if not self.request_frames:
+                for shard in shards:
+                    self._drop_pending(shard, src)
+            if any(s.active and not s.pending for s in shards):
+                return
+
+            heads = [s for s in shards if s.pending]
+            if not heads:
+                self._stop_source(src)
+                return
+
+            shard = min(heads, key=lambda s: s.pending[0].frame)
+            obj = shard.pending.popleft()
+
+            objects = shard.detections[obj.idx][: obj.count]
+            img = shard.images[obj.idx]
+            resp = NewFrame(
+                img, objects, src, obj.latency, obj.tiles, obj.imgsz, obj.times
+            )
+            self.new_frame.emit(resp)
+
+            # The image shown before is free now, which makes room for
+            # another frame
+            if shard.shown_idx != -1:
+                self._ack(shard, src, shard.shown_idx)
+                if not self.streaming and self.request_frames:
+                    self._request(shard, src)
+            shard.shown_idx = obj.idx
+
+    def _request(self, shard: Shard, src: int):
+        shard.requested += 1
+        self.workers[shard.worker].pipe.send(CmdGetFrame(src))
+
+    def _ack(self, shard: Shard, src: int, idx: int):
+        self.workers[shard.worker].pipe.send(CmdAckFrame(idx, src))
+
+    def _drop_pending(self, shard: Shard, src: int):
+        """Forget received frames which are not shown, freeing their images"""
+        for obj in shard.pending:
+            self._ack(shard, src, obj.idx)
+        shard.pending.clear()
+
+    def _stop_source(self, src: int):
+        """The source `src` sends no more frames"""
+        if src not in self.active:
+            return
+        self.active.discard(src)
+        if self.active:
+            return
+
+        self.requesting_frames = False
+        self.streaming = False
+        self.frames_stopped.emit()
+
+    def _reset_shm_image(self, src: int | None = None):
+        """Unmap the images of the source `src`, or of all sources"""
+        keys = list(self.sources) if src is None else [src]
+        for key in keys:
+            for shard in self.sources.pop(key, []):
+                # Views into shared memory must be gone before it can be closed
+                shard.images = []
+                shard.detections = []
+                shard.pending.clear()
+                for shm in shard.shm_images:
+                    shm.close()
@@ -1,14 +1,32 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from typing import Literal
 
+import numpy as np
+from numpy.typing import NDArray
+
 
 class Klass(Enum):
     Chicken = 0
     Egg = 1
 
 
-SrcType = Literal["camera", "video", "image", "video_url"]
+SrcType = Literal["camera", "video", "image", "video_url", "synthetic"]
+
+# What runs the model: PyTorch, or a model exported for ONNX Runtime or OpenVINO
+Backend = Literal["torch", "onnx", "openvino"]
+
+# A polygon, with points as fractions of the frame's width and height
+Roi = list[tuple[float, float]]
+
+
+def rect_roi(x1: float, y1: float, x2: float, y2: float) -> Roi:
+    return [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+
+
+# What the capture thread does when all images are in use:
+# wait for one, overwrite the oldest unsent frame, or keep only the newest frame
+DropPolicy = Literal["block", "drop_oldest", "latest_only"]
 
 
 @dataclass
@@ -23,7 +41,18 @@ class MsgTerminated:
 
 @dataclass
 class CmdSetModel:
+    """Load a model; a PyTorch model is exported for other backends"""
+
     model_path: str
+    backend: Backend = "torch"
+
+
+@dataclass
+class CmdSetThreads:
+    """Let the model use up to `threads` threads, 0 for one per core; has no
+    reply"""
+
+    threads: int
 
 
 @dataclass
@@ -35,6 +64,42 @@ class ReplySetModel:
 class CmdSetSrc:
     src_type: SrcType
     src_value: str
+    # Frames detected with a single model call
+    batch: int = 1
+    # Number of shared memory images, 0 to derive it from `batch`
+    depth: int = 0
+    policy: DropPolicy = "block"
+    # Sources are numbered by the runner, setting one replaces it
+    src: int = 0
+    # Without tracking, objects get new negative ids in every frame
+    track: bool = True
+    # Read only every `shards`-th frame of a video, starting at frame `shard`
+    shard: int = 0
+    shards: int = 1
+    # Detect every n-th frame only, predicting tracks in between
+    keyframe_interval: int = 1
+    # Also detect once predictions may be off by half an object's height
+    adaptive_keyframes: bool = False
+    # Detect only in these regions instead of the whole frame
+    rois: list[Roi] = field(default_factory=list)
+    # Columns and rows of tiles each region is split into, for small objects
+    tile_grid: tuple[int, int] = (1, 1)
+    # Fraction of a tile's size shared with its neighbours
+    tile_overlap: float = 0.2
+    # Frames which differ less from the last detected one, in gray levels, keep
+    # its objects. 0 detects every frame.
+    motion_threshold: float = 0.0
+    # Most frames in a row which keep the objects of an earlier one
+    motion_max_skips: int = 30
+    # Detect at the aspect ratio of the frame instead of a square
+    rect: bool = False
+    # Frame rate and milliseconds per frame the model should keep up with, by
+    # adapting the input size. 0 keeps the default size.
+    target_fps: float = 0.0
+    target_latency: float = 0.0
+    # Keep the boxes found in a video file on disk, and reuse them when it is
+    # detected again with the same model and settings
+    cache_detections: bool = False
 
 
 @dataclass
@@ -43,32 +108,167 @@ class ReplySetSrc:
     shm_names: list[str]
     width: int
     height: int
+    src: int = 0
+
+
+@dataclass
+class CmdCloseSrc:
+    """Detach the source `src`; has no reply"""
+
+    src: int
 
 
 @dataclass
 class CmdGetFrame:
-    pass
+    """Send the next frame; its image is held until `CmdAckFrame`
+
+    Several frames may be requested before the first one arrives.
+    """
+
+    src: int = 0
+
+
+# Layout of the detected objects stored next to each image in shared memory
+DETECTION_DTYPE = np.dtype(
+    [
+        ("id", np.int32),
+        ("klass", np.int32),
+        ("confidence", np.float32),
+        ("x1", np.int32),
+        ("y1", np.int32),
+        ("x2", np.int32),
+        ("y2", np.int32),
+        # Predicted from earlier frames instead of detected in this one
+        ("predicted", np.bool_),
+    ]
+)
+MAX_OBJECTS = 300
+
+Detections = NDArray[np.void]
+
+
+def mk_detections(count: int) -> Detections:
+    return np.zeros(count, dtype=DETECTION_DTYPE)
+
+
+def detections_offset(width: int, height: int):
+    """Where the detections start in an image's shared memory"""
+    img_size = width * height * 3
+    return (img_size + 63) // 64 * 64
+
+
+def shm_size(width: int, height: int):
+    return detections_offset(width, height) + MAX_OBJECTS * DETECTION_DTYPE.itemsize
 
 
 @dataclass
-class DetectedObject:
-    id: int
-    klass: Klass
-    confidence: float
-    x1: int
-    y1: int
-    x2: int
-    y2: int
+class FrameTimes:
+    """When a frame passed each stage, by `time.monotonic()`, 0 if it did not
+
+    Frames which are not detected skip `preprocessed` and `inferred`. The
+    last three are stamped by the runner and the GUI.
+    """
+
+    # Reading the frame from its source started
+    read: float = 0.0
+    captured: float = 0.0
+    # Cropped to regions and tiles
+    preprocessed: float = 0.0
+    inferred: float = 0.0
+    tracked: float = 0.0
+    # Handed to the pipe, which serializes it
+    sent: float = 0.0
+    received: float = 0.0
+    filtered: float = 0.0
+    painted: float = 0.0
 
 
 @dataclass
 class ReplyGetFrame:
     ok: bool
     idx: int
-    objects: list[DetectedObject]
+    # Number of valid detections stored with the image `idx`
+    count: int
+    # Source whose images `idx` refers to
+    src: int = 0
+    # Position of the frame in its source
+    frame: int = -1
+    # Time the model took for this frame, in milliseconds
+    latency: float = 0.0
+    # Images detected for this frame: one per tile of each region
+    tiles: int = 1
+    # Height and width of the model input when the frame was last detected
+    imgsz: tuple[int, int] = (0, 0)
+    times: FrameTimes = field(default_factory=FrameTimes)
+
+
+@dataclass
+class CmdStartStream:
+    """Push frames as soon as they are detected, instead of `CmdGetFrame`
+
+    Pushed frames are `ReplyGetFrame`s. The runner may hold `credits`
+    images at a time and returns them with `CmdAckFrame`. The stream ends
+    with a frame which is not ok, either when the source has no frames left
+    or after `CmdStopStream`. Each source is streamed on its own.
+    """
+
+    credits: int
+    src: int = 0
+
+
+@dataclass
+class CmdAckFrame:
+    """Release the image `idx`; has no reply"""
+
+    idx: int
+    src: int = 0
 
 
-Cmd = CmdTerminate | CmdSetModel | CmdSetSrc | CmdGetFrame
-CmdReply = MsgTerminated | ReplySetModel | ReplySetSrc | ReplyGetFrame
+@dataclass
+class CmdStopStream:
+    src: int = 0
+
+
+@dataclass
+class CmdGetStats:
+    src: int = 0
+
+
+@dataclass
+class StageStats:
+    """Frame counters of one stage of the detection process
+
+    `stalled` counts how often the stage had to wait for its input: a free
+    image for capture, a captured frame for detect and a detected frame
+    for send. `dropped` counts frames discarded while waiting for the stage.
+    `skipped` counts frames passed on without detection since they were
+    static.
+    """
+
+    frames: int = 0
+    dropped: int = 0
+    stalled: int = 0
+    skipped: int = 0
+
+
+@dataclass
+class ReplyGetStats:
+    ok: bool
+    capture: StageStats = field(default_factory=StageStats)
+    detect: StageStats = field(default_factory=StageStats)
+    send: StageStats = field(default_factory=StageStats)
 
 
+Cmd = (
+    CmdTerminate
+    | CmdSetModel
+    | CmdSetThreads
+    | CmdSetSrc
+    | CmdCloseSrc
+    | CmdGetFrame
+    | CmdStartStream
+    | CmdAckFrame
+    | CmdStopStream
+    | CmdGetStats
+)
+CmdReply = MsgTerminated | ReplySetModel | ReplySetSrc | ReplyGetFrame | ReplyGetStats
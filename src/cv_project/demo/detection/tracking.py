@@ -0,0 +1,134 @@
+import numpy as np
+from numpy.typing import NDArray
+from ultralytics.engine.results import Results
+from ultralytics.trackers.basetrack import BaseTrack
+from ultralytics.trackers.byte_tracker import BYTETracker, STrack
+from ultralytics.utils import YAML, IterableSimpleNamespace
+from ultralytics.utils.checks import check_yaml
+
+from ..utils import Img
+
+# x1, y1, x2, y2, confidence, class
+Boxes = NDArray[np.float32]
+# x1, y1, x2, y2, id, confidence, class; id is -1 for untracked boxes
+Tracks = NDArray[np.float32]
+
+
+def result_boxes(result: Results) -> Boxes:
+    if result.boxes is None:
+        return np.empty((0, 6), dtype=np.float32)
+    return result.boxes.data.cpu().numpy().astype(np.float32)
+
+
+def untracked(boxes: Boxes) -> Tracks:
+    ids = np.full((len(boxes), 1), -1, dtype=np.float32)
+    return np.concatenate([boxes[:, :4], ids, boxes[:, 4:6]], axis=1)
+
+
+class _TrackerInput:
+    """What `BYTETracker.update` reads from `ultralytics.engine.results.Boxes`"""
+
+    def __init__(self, boxes: Boxes):
+        xyxy = boxes[:, :4]
+        self.conf: NDArray[np.float32] = boxes[:, 4]
+        self.cls: NDArray[np.float32] = boxes[:, 5]
+        self.xywh: NDArray[np.float32] = np.concatenate(
+            [(xyxy[:, :2] + xyxy[:, 2:]) / 2, xyxy[:, 2:] - xyxy[:, :2]], axis=1
+        )
+
+    def __len__(self):
+        return len(self.conf)
+
+
+class Tracker:
+    """ByteTrack, fed with detections of one frame at a time in frame order.
+
+    Mirrors what `Model.track(persist=True, tracker="bytetrack.yaml")` does
+    after each prediction, so that detection can run on batches of frames.
+
+    Several trackers can be used side by side. Track ids come from a counter
+    shared by all of them, which `BYTETracker` resets, so each tracker keeps
+    its own.
+
+    Frames without detections can be skipped, the tracks are then predicted
+    by ByteTrack's Kalman filter.
+    """
+
+    def __init__(self, config: str = "bytetrack.yaml"):
+        cfg = IterableSimpleNamespace(**YAML.load(check_yaml(config)))
+        self.tracker: BYTETracker = BYTETracker(args=cfg, frame_rate=30)
+        self.last_id: int = 0
+        # Frames since the last update
+        self.skipped: int = 0
+
+    def predicted(self, steps: int) -> tuple[Tracks, float]:
+        """Tracks expected `steps` frames after the last update
+
+        Also returns how far the predictions may be off: the largest shift
+        plus standard deviation of a track's center, relative to its height.
+        """
+        stracks = [t for t in self.tracker.tracked_stracks if t.is_activated]
+        if not stracks:
+            return np.empty((0, 7), dtype=np.float32), 0.0
+
+        start = np.array([t.mean for t in stracks])
+        mean = start
+        cov = np.array([t.covariance for t in stracks])
+        for _ in range(steps):
+            mean, cov = STrack.shared_kalman.multi_predict(mean, cov)
+
+        # x, y, aspect ratio, height
+        x, y, a, h = mean[:, 0], mean[:, 1], mean[:, 2], mean[:, 3]
+        w = a * h
+        tracks = np.stack(
+            [
+                x - w / 2,
+                y - h / 2,
+                x + w / 2,
+                y + h / 2,
+                [t.track_id for t in stracks],
+                [t.score for t in stracks],
+                [t.cls for t in stracks],
+            ],
+            axis=1,
+        ).astype(np.float32)
+
+        shift = np.hypot(x - start[:, 0], y - start[:, 1])
+        std = np.sqrt(cov[:, 0, 0] + cov[:, 1, 1])
+        drift = float(np.max((shift + std) / np.maximum(h, 1)))
+        return tracks, drift
+
+    def skip(self) -> Tracks:
+        """Predict the tracks in a frame which is not detected"""
+        self.advance()
+        tracks, _ = self.predicted(self.skipped)
+        return tracks
+
+    def advance(self):
+        """Count a frame without an update
+
+        Lost tracks expire after `track_buffer` frames, skipped ones included.
+        """
+        self.skipped += 1
+        self.tracker.frame_id += 1
+
+    def update(self, boxes: Boxes, img: Img) -> Tracks:
+        if len(boxes) == 0:
+            self.advance()
+            return np.empty((0, 7), dtype=np.float32)
+
+        # `BYTETracker.update` predicts a single step
+        pool = [t for t in self.tracker.tracked_stracks if t.is_activated]
+        for _ in range(self.skipped):
+            STrack.multi_predict(pool + self.tracker.lost_stracks)
+        self.skipped = 0
+
+        BaseTrack._count = self.last_id  # pyright: ignore[reportPrivateUsage]
+        try:
+            tracks = self.tracker.update(_TrackerInput(boxes), img)
+        finally:
+            self.last_id = BaseTrack._count  # pyright: ignore[reportPrivateUsage]
+        if len(tracks) == 0:
+            return untracked(boxes)
+
+        return tracks[:, :7].astype(np.float32)
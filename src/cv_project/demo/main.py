@@ -1,17 +1,17 @@
 import sys
 from dataclasses import dataclass
 from enum import Enum
-from itertools import chain
 from pathlib import Path
-from time import time
-from typing import final, override
+from time import monotonic, time
+from typing import cast, final, get_args, override
 
-from names_generator import generate_name
+import numpy as np
 from PySide6.QtCore import (
     QObject,
     QPoint,
     QRect,
     QSize,
+    QTimer,
     Signal,
 )
 from PySide6.QtGui import (
@@ -33,23 +33,28 @@ from PySide6.QtWidgets import (
     QRadioButton,
     QSizePolicy,
     QSlider,
+    QSpinBox,
     QVBoxLayout,
     QWidget,
 )
 
 from cv_project.demo.detection.runner import DetectionRunner, NewFrame
 from cv_project.demo.detection.schemas import (
-    DetectedObject,
+    Backend,
+    DropPolicy,
+    FrameTimes,
     Klass,
+    ReplyGetStats,
+    Roi,
     SrcType,
+    mk_detections,
+    rect_roi,
 )
 
-from .state import ChickenInfo, EggInfo, ObjectInfo, State
+from .scheduler import DisplayScheduler
+from .state import State, scene
 from .state_display import LayeredDisplay, LayerId
-from .utils import (
-    distance_between_rects,
-    img_size,
-)
+from .utils import img_size, img_to_pixmap
 
 
 class Preset(Enum):
@@ -70,6 +75,7 @@ def set_preset(preset: Preset, options: "Options", display_options: "DisplayOpti
             options.model.setCurrentText("models/g0t0_e100b20s.pt")
             options.source_file.setChecked(True)
             options.source_value.setText("./conveyor.mp4")
+            options.cache_detections.setChecked(True)
             display_options.layers[LayerId.BOXES.value].setChecked(True)
             display_options.layers[LayerId.LABELS.value].setChecked(True)
             display_options.layers[LayerId.CONNECTIONS.value].setChecked(False)
@@ -81,6 +87,7 @@ def set_preset(preset: Preset, options: "Options", display_options: "DisplayOpti
             options.model.setCurrentText("models/g0t0_e100b20s.pt")
             options.source_file.setChecked(True)
             options.source_value.setText("./video.mp4")
+            options.cache_detections.setChecked(True)
             display_options.layers[LayerId.BOXES.value].setChecked(True)
             display_options.layers[LayerId.LABELS.value].setChecked(True)
             display_options.layers[LayerId.CONNECTIONS.value].setChecked(False)
@@ -92,6 +99,7 @@ def set_preset(preset: Preset, options: "Options", display_options: "DisplayOpti
             options.model.setCurrentText("models/g0t0_e100b20s.pt")
             options.source_file.setChecked(True)
             options.source_value.setText("./chickeggs.mp4")
+            options.cache_detections.setChecked(True)
             display_options.layers[LayerId.BOXES.value].setChecked(True)
             display_options.layers[LayerId.LABELS.value].setChecked(True)
             display_options.layers[LayerId.CONNECTIONS.value].setChecked(True)
@@ -122,6 +130,8 @@ class BoxerFilter(QObject):
         self.f = False
         self.chickens = False
         self.confidence_threashold: int = 50
+        # Eggs a chicken may have at most, 0 gives each egg its closest chicken
+        self.egg_capacity = 0
 
         self.last = time()
         self.cnt = 0
@@ -138,6 +148,9 @@ class BoxerFilter(QObject):
     def set_min_confidence(self, x: int):
         self.confidence_threashold = x
 
+    def set_egg_capacity(self, x: int):
+        self.egg_capacity = x
+
     def on_updated(self, new_frame: NewFrame):
         # TODO: keep track of ids, for new ids - strict confidence level check, for old - lax?
         # TODO: naming, here or in the BoxesLayer?
@@ -146,19 +159,25 @@ class BoxerFilter(QObject):
         cur = time()
         delta = cur - self.last
         if delta > 1:
-            print(self.cnt / delta)
+            per_tile = new_frame.latency / new_frame.tiles
+            print(
+                self.cnt / delta,
+                "fps,",
+                f"{new_frame.latency:.1f}ms per frame,",
+                f"{new_frame.tiles} tiles, {per_tile:.1f}ms per tile,",
+                "input {}x{}".format(*reversed(new_frame.imgsz)),
+            )
             self.last = cur
             self.cnt = 0
 
         self.state.img = new_frame.img
+        self.state.pixmap = img_to_pixmap(new_frame.img)
         self.state.image_updated.emit()
 
-        self.state.remove_all_objects()
-
-        fake_eggs = list[DetectedObject]()
+        EGGS = 5
+        fake_eggs = mk_detections(EGGS if self.add_fake_eggs else 0)
         if self.add_fake_eggs:
             size = img_size(self.state.img)
-            EGGS = 5
             for idx in range(EGGS):
                 rect = QRect(0, 0, 20, 30)
 
@@ -166,59 +185,32 @@ class BoxerFilter(QObject):
                     QPoint(int(20 + size.width() / 6 * idx), int(size.height() / 2))
                 )
 
-                fake_eggs.append(
-                    DetectedObject(
-                        1000000 + idx,
-                        Klass.Egg,
-                        0.9,
-                        rect.left(),
-                        rect.top(),
-                        rect.right(),
-                        rect.bottom(),
-                    )
+                fake_eggs[idx] = (
+                    1000000 + idx,
+                    Klass.Egg.value,
+                    0.9,
+                    rect.left(),
+                    rect.top(),
+                    rect.right(),
+                    rect.bottom(),
+                    False,
                 )
 
         if not self.f:
             self.state.all_egg_ids = set()
 
-        for obj in chain(new_frame.objects, fake_eggs):
-            if int(obj.confidence * 100) < self.confidence_threashold:
-                continue
-
-            if self.chickens and obj.klass == Klass.Chicken:
-                continue
-            info = ObjectInfo(
-                obj.id,
-                obj.klass,
-                obj.confidence,
-                QRect(QPoint(obj.x1, obj.y1), QPoint(obj.x2, obj.y2)),
-            )
-
-            self.state.objects[obj.id] = info
-            if obj.klass == Klass.Chicken:
-                self.state.chickens[obj.id] = ChickenInfo(
-                    visible=True,
-                    name=generate_name(style="capital", seed=obj.id),
-                    obj=info,
-                    eggs=[],
-                )
-            else:
-                self.state.eggs[obj.id] = EggInfo(visible=True, obj=info, chicken=None)
-
-        for egg in self.state.eggs.values():
-            self.state.all_egg_ids.add(egg.obj.id)
-            dists = [
-                (chicken, distance_between_rects(egg.obj.rect, chicken.obj.rect))
-                for chicken in self.state.chickens.values()
-            ]
-            dists = sorted(dists, key=lambda x: x[1])
-            if len(dists) > 0:
-                chicken = dists[0][0]
-                chicken.eggs.append(egg)
-                egg.chicken = chicken
+        detected = np.concatenate([new_frame.objects, fake_eggs])
+        objects, chickens, eggs = scene(
+            detected,
+            self.confidence_threashold,
+            hide_chickens=self.chickens,
+            egg_capacity=self.egg_capacity,
+        )
+        self.state.all_egg_ids.update(eggs)
+        self.state.commit(objects, chickens, eggs)
 
-        for id in self.state.objects:
-            self.state.object_added.emit(id)
+        new_frame.times.filtered = monotonic()
+        self.state.times = new_frame.times
 
 
 @final
@@ -228,8 +220,6 @@ class MainWindow(QWidget):
     def __init__(self):
         super().__init__()
         self.state = State()
-        self.runner = DetectionRunner()
-        self.runner.start()
 
         # Video widget
 
@@ -335,6 +325,9 @@ class MainWindow(QWidget):
         #     upd(self.layer_options.scale.isChecked())
 
         self.filter = BoxerFilter(self.state)
+        # Frames reach the filter at most once per screen refresh
+        self.scheduler = DisplayScheduler()
+        _ = self.scheduler.frame_due.connect(self.filter.on_updated)
         self.filter.add_fake_eggs = self.options.fake_eggs.isChecked()
         _ = self.options.fake_eggs.toggled.connect(self.filter.set_add_fake_eggs)
         self.filter.f = self.layer_options.conv.isChecked()
@@ -345,13 +338,29 @@ class MainWindow(QWidget):
         _ = self.layer_options.confidence.valueChanged.connect(
             self.filter.set_min_confidence
         )
+        self.filter.set_egg_capacity(self.layer_options.egg_capacity.value())
+        _ = self.layer_options.egg_capacity.valueChanged.connect(
+            self.filter.set_egg_capacity
+        )
 
-        _ = self.runner.new_frame.connect(self.filter.on_updated)
-        _ = self.runner.frames_started.connect(self._on_started)
-        _ = self.runner.frames_stopped.connect(self._on_stopped)
+        self.start_runner(self.options.workers.value())
+        _ = self.state.frame_painted.connect(self._on_painted)
+
+        self.stats_timer = QTimer(self)
+        self.stats_timer.setInterval(5000)
+        _ = self.stats_timer.timeout.connect(
+            lambda: self.runner.get_stats(self._on_stats)
+        )
 
         self.set_action("Start")
 
+    def start_runner(self, workers: int):
+        self.runner = DetectionRunner(workers)
+        _ = self.runner.new_frame.connect(self.scheduler.on_frame)
+        _ = self.runner.frames_started.connect(self._on_started)
+        _ = self.runner.frames_stopped.connect(self._on_stopped)
+        self.runner.start()
+
     @override
     def closeEvent(self, event: QCloseEvent, /) -> None:
         self.runner.stop()
@@ -375,24 +384,82 @@ class MainWindow(QWidget):
 
     def _on_started(self):
         self.set_action("Stop")
+        self.stats_timer.start()
 
     def _on_stopped(self):
+        self.stats_timer.stop()
+        self.runner.get_stats(self._on_stats)
         self.set_action("Clear")
 
+    def _on_painted(self, times: FrameTimes):
+        self.runner.frame_done(times)
+
+    def _on_stats(self, stats: ReplyGetStats):
+        if not stats.ok:
+            return
+        for name, stage in (
+            ("capture", stats.capture),
+            ("detect", stats.detect),
+            ("send", stats.send),
+        ):
+            print(
+                f"{name}: {stage.frames} frames,"
+                f" {stage.dropped} dropped, {stage.stalled} stalled"
+            )
+        for stage, (p50, p95, p99) in self.runner.latency_percentiles().items():
+            print(f"{stage}: p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms")
+        if stats.detect.skipped:
+            skip_ratio = stats.detect.skipped / max(1, stats.detect.frames)
+            print(f"static: {skip_ratio:.0%} of detected frames skipped")
+        print(
+            f"display: {self.scheduler.shown} frames, {self.scheduler.dropped} dropped"
+        )
+
     def clear(self):
+        self.scheduler.clear()
         self.state.reset()
         self.set_action("Start")
 
     def _start(self):
-        self.runner.set_model(self.options.model.currentText(), self._on_model)
+        if self.options.workers.value() != len(self.runner.workers):
+            self.runner.stop()
+            self.start_runner(self.options.workers.value())
+        self.runner.set_model(
+            self.options.model.currentText(),
+            self._on_model,
+            backend=self.options.backend,
+        )
 
     def _on_model(self, ok: bool):
         if not ok:
             _ = QMessageBox.warning(self, "Nope", "set_model failed")
             self.clear()
             return
+        try:
+            rois = self.options.rois
+        except ValueError:
+            _ = QMessageBox.warning(self, "Nope", "invalid regions")
+            self.clear()
+            return
         self.runner.set_source(
-            self.options.src_type, self.options.source_value.text(), self._on_source
+            self.options.src_type,
+            self.options.source_value.text(),
+            self._on_source,
+            batch=self.options.batch.value(),
+            depth=self.options.depth.value(),
+            policy=self.options.policy,
+            split_frames=self.options.split_frames.isChecked(),
+            keyframe_interval=self.options.keyframe_interval.value(),
+            adaptive_keyframes=self.options.adaptive_keyframes.isChecked(),
+            rois=rois,
+            tile_grid=(self.options.tile_cols.value(), self.options.tile_rows.value()),
+            tile_overlap=self.options.tile_overlap.value() / 100,
+            motion_threshold=self.options.motion_threshold.value(),
+            motion_max_skips=self.options.motion_max_skips.value(),
+            rect=self.options.rect.isChecked(),
+            target_fps=self.options.target_fps.value(),
+            target_latency=self.options.target_latency.value(),
+            cache_detections=self.options.cache_detections.isChecked(),
         )
 
     def _on_source(self, ok: bool):
@@ -401,7 +468,7 @@ class MainWindow(QWidget):
             self.clear()
             return
 
-        self.runner.start_frames()
+        self.runner.start_frames(streaming=self.options.streaming.isChecked())
 
     def set_action(self, act: str):
         self.action.setText(act)
@@ -438,8 +505,7 @@ class DisplayInfo(QFrame):
         super().__init__()
         self.state = state
         _ = self.state.was_reset.connect(self.update_count)
-        _ = self.state.object_added.connect(self.update_count)
-        _ = self.state.object_removed.connect(self.update_count)
+        _ = self.state.frame_committed.connect(self.update_count)
 
         self.setStyleSheet("background-color: lightgray; color: black;")
         layout = QGridLayout(self)
@@ -500,6 +566,12 @@ class DisplayOptions(QFrame):
         self.hide_chickens.setChecked(False)
         layout.addWidget(self.hide_chickens)
 
+        layout.addWidget(QLabel("Eggs per chicken (0: closest chicken)"))
+        self.egg_capacity = QSpinBox()
+        self.egg_capacity.setRange(0, 100)
+        self.egg_capacity.setValue(0)
+        layout.addWidget(self.egg_capacity)
+
         # self.scale = QCheckBox("Scale video")
         # layout.addWidget(self.scale)
 
@@ -524,7 +596,11 @@ class Options(QFrame):
 
         layout.addWidget(QLabel("**Model**", textFormat=Qt.TextFormat.MarkdownText))
         self.model = QComboBox()
-        found_models = list(Path("models").glob("**/*.pt"))
+        found_models = [
+            *Path("models").glob("**/*.pt"),
+            *Path("models").glob("**/*.onnx"),
+            *Path("models").glob("**/*_openvino_model"),
+        ]
         if len(found_models) == 0:
             layout.addWidget(QLabel("!!!! No models found at ./models !!!!"))
         else:
@@ -533,6 +609,88 @@ class Options(QFrame):
             layout.addWidget(self.model)
             self.model.setCurrentIndex(0)
 
+        layout.addWidget(QLabel("Backend"))
+        self.model_backend = QComboBox()
+        for backend in get_args(Backend):
+            self.model_backend.addItem(backend, backend)
+        layout.addWidget(self.model_backend)
+
+        layout.addWidget(QLabel("Frames per batch"))
+        self.batch = QSpinBox()
+        self.batch.setRange(1, 8)
+        self.batch.setValue(1)
+        layout.addWidget(self.batch)
+
+        layout.addWidget(QLabel("Buffered frames"))
+        self.depth = QSpinBox()
+        self.depth.setRange(0, 32)
+        self.depth.setSpecialValueText("auto")
+        self.depth.setValue(0)
+        layout.addWidget(self.depth)
+
+        layout.addWidget(QLabel("When the buffer is full"))
+        self.drop_policy = QComboBox()
+        for policy in get_args(DropPolicy):
+            self.drop_policy.addItem(policy.replace("_", " "), policy)
+        layout.addWidget(self.drop_policy)
+
+        self.rect = QCheckBox("Detect at the frame's aspect ratio")
+        self.rect.setChecked(False)
+        layout.addWidget(self.rect)
+
+        layout.addWidget(QLabel("Adapt the input size to hold (fps, ms per frame)"))
+        self.target_fps = QSpinBox()
+        self.target_fps.setRange(0, 120)
+        self.target_fps.setSpecialValueText("off")
+        self.target_fps.setValue(0)
+        layout.addWidget(self.target_fps)
+        self.target_latency = QSpinBox()
+        self.target_latency.setRange(0, 1000)
+        self.target_latency.setSpecialValueText("off")
+        self.target_latency.setValue(0)
+        layout.addWidget(self.target_latency)
+
+        layout.addWidget(QLabel("Detect every n-th frame"))
+        self.keyframe_interval = QSpinBox()
+        self.keyframe_interval.setRange(1, 10)
+        self.keyframe_interval.setValue(1)
+        layout.addWidget(self.keyframe_interval)
+
+        self.adaptive_keyframes = QCheckBox("Detect earlier on fast motion")
+        self.adaptive_keyframes.setChecked(False)
+        layout.addWidget(self.adaptive_keyframes)
+
+        layout.addWidget(QLabel("Skip frames changed by less than (gray levels)"))
+        self.motion_threshold = QSpinBox()
+        self.motion_threshold.setRange(0, 50)
+        self.motion_threshold.setSpecialValueText("off")
+        self.motion_threshold.setValue(0)
+        layout.addWidget(self.motion_threshold)
+
+        layout.addWidget(QLabel("Most static frames skipped in a row"))
+        self.motion_max_skips = QSpinBox()
+        self.motion_max_skips.setRange(1, 300)
+        self.motion_max_skips.setValue(30)
+        layout.addWidget(self.motion_max_skips)
+
+        self.streaming = QCheckBox("Push frames")
+        self.streaming.setChecked(False)
+        layout.addWidget(self.streaming)
+
+        layout.addWidget(QLabel("Detection processes"))
+        self.workers = QSpinBox()
+        self.workers.setRange(1, 16)
+        self.workers.setValue(1)
+        layout.addWidget(self.workers)
+
+        self.split_frames = QCheckBox("Split videos across processes (no tracking)")
+        self.split_frames.setChecked(False)
+        layout.addWidget(self.split_frames)
+
+        self.cache_detections = QCheckBox("Reuse detections of replayed videos")
+        self.cache_detections.setChecked(False)
+        layout.addWidget(self.cache_detections)
+
         # END Model choice
 
         layout.addWidget(QLabel("**Source**", textFormat=Qt.TextFormat.MarkdownText))
@@ -557,9 +715,37 @@ class Options(QFrame):
         )
         layout.addWidget(self.source_file)
 
+        self.default_synthetic = "640x360@30:0"
+        self.source_synthetic = QRadioButton("synthetic (WxH@fps:seed:frames)")
+        _ = self.source_synthetic.toggled.connect(
+            lambda on: self.source_value.setText(self.default_synthetic) if on else None
+        )
+        layout.addWidget(self.source_synthetic)
+
         self.source_value = QLineEdit()
         layout.addWidget(self.source_value)
 
+        layout.addWidget(QLabel("Detected regions"))
+        self.regions = QLineEdit()
+        self.regions.setPlaceholderText(
+            "whole frame, or x1,y1,x2,y2 / x,y x,y x,y ...; ... in 0..1"
+        )
+        layout.addWidget(self.regions)
+
+        layout.addWidget(QLabel("Tiles per region (columns, rows, overlap %)"))
+        self.tile_cols = QSpinBox()
+        self.tile_cols.setRange(1, 8)
+        self.tile_cols.setValue(1)
+        layout.addWidget(self.tile_cols)
+        self.tile_rows = QSpinBox()
+        self.tile_rows.setRange(1, 8)
+        self.tile_rows.setValue(1)
+        layout.addWidget(self.tile_rows)
+        self.tile_overlap = QSpinBox()
+        self.tile_overlap.setRange(0, 50)
+        self.tile_overlap.setValue(20)
+        layout.addWidget(self.tile_overlap)
+
         self.source_camera.setChecked(True)
 
         self.fake_eggs = QCheckBox("Fake eggs")
@@ -571,8 +757,32 @@ class Options(QFrame):
             return "camera"
         if self.source_file.isChecked():
             return "video"
+        if self.source_synthetic.isChecked():
+            return "synthetic"
         return "video_url"
 
+    @property
+    def policy(self) -> DropPolicy:
+        return cast(DropPolicy, self.drop_policy.currentData())
+
+    @property
+    def rois(self) -> list[Roi]:
+        """Rectangles `x1,y1,x2,y2` or polygons `x,y x,y x,y`, separated by `;`"""
+        rois: list[Roi] = []
+        for region in self.regions.text().split(";"):
+            points = [[float(v) for v in p.split(",")] for p in region.split()]
+            if not points:
+                continue
+            if len(points) == 1 and len(points[0]) == 4:
+                rois.append(rect_roi(*points[0]))
+            else:
+                rois.append([(x, y) for x, y in points])
+        return rois
+
+    @property
+    def backend(self) -> Backend:
+        return cast(Backend, self.model_backend.currentData())
+
 
 def main():
     app = QApplication(sys.argv)
@@ -0,0 +1,62 @@
+from typing import final
+
+from PySide6.QtCore import QObject, Qt, QTimer, Signal
+from PySide6.QtGui import QGuiApplication
+
+from .detection.runner import NewFrame
+
+# Used when the screen does not tell its refresh rate
+DEFAULT_REFRESH_RATE = 60.0
+
+
+def refresh_interval():
+    """Milliseconds between two refreshes of the primary screen"""
+    screen = QGuiApplication.primaryScreen()
+    rate = screen.refreshRate() if screen is not None else 0.0
+    if rate <= 0:
+        rate = DEFAULT_REFRESH_RATE
+    return max(1, round(1000 / rate))
+
+
+@final
+class DisplayScheduler(QObject):
+    """Passes on the newest frame once per screen refresh
+
+    A frame which is replaced by a newer one before the next refresh is
+    never shown and counted as dropped.
+    """
+
+    frame_due = Signal(NewFrame)
+
+    def __init__(self):
+        super().__init__()
+
+        self.pending: NewFrame | None = None
+        self.shown = 0
+        self.dropped = 0
+
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.setInterval(refresh_interval())
+        _ = self.timer.timeout.connect(self.on_refresh)
+
+    def on_frame(self, frame: NewFrame):
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = frame
+        # Idle while no frames arrive
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def on_refresh(self):
+        frame = self.pending
+        if frame is None:
+            self.timer.stop()
+            return
+        self.pending = None
+        self.shown += 1
+        self.frame_due.emit(frame)
+
+    def clear(self):
+        self.pending = None
+        self.timer.stop()
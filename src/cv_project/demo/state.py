@@ -1,14 +1,19 @@
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
 from typing import final
 
+from names_generator import generate_name
 from PySide6.QtCore import (
     QObject,
+    QPoint,
     QRect,
     Signal,
 )
+from PySide6.QtGui import QPixmap
 
-from .detection.schemas import Klass
-from .utils import Img
+from .detection.association import associate, rects
+from .detection.schemas import Detections, FrameTimes, Klass
+from .utils import Img, coords
 
 
 @dataclass
@@ -34,35 +39,144 @@ class EggInfo:
     chicken: ChickenInfo | None
 
 
+@dataclass
+class SceneDiff:
+    """Ids of the objects which changed with a frame"""
+
+    added: set[int] = field(default_factory=set)
+    # Objects which moved, or whose eggs or chicken changed
+    updated: set[int] = field(default_factory=set)
+    removed: set[int] = field(default_factory=set)
+
+
+def scene(
+    detected: Detections,
+    confidence_threshold: int = 0,
+    hide_chickens: bool = False,
+    egg_capacity: int = 0,
+):
+    """Objects, chickens and eggs of a frame's detections, by id
+
+    Objects below `confidence_threshold` percent are left out. Each egg goes
+    to its closest chicken, see `associate`.
+    """
+    objects: dict[int, ObjectInfo] = {}
+    chickens: dict[int, ChickenInfo] = {}
+    eggs: dict[int, EggInfo] = {}
+
+    for id, klass, confidence, x1, y1, x2, y2, _ in detected.tolist():
+        if int(confidence * 100) < confidence_threshold:
+            continue
+
+        klass = Klass(klass)
+        if hide_chickens and klass == Klass.Chicken:
+            continue
+        info = ObjectInfo(
+            id,
+            klass,
+            confidence,
+            QRect(QPoint(x1, y1), QPoint(x2, y2)),
+        )
+
+        objects[id] = info
+        if klass == Klass.Chicken:
+            chickens[id] = ChickenInfo(
+                visible=True,
+                name=generate_name(style="capital", seed=id),
+                obj=info,
+                eggs=[],
+            )
+        else:
+            eggs[id] = EggInfo(visible=True, obj=info, chicken=None)
+
+    chicken_list = list(chickens.values())
+    owners = associate(
+        rects([coords(egg.obj.rect) for egg in eggs.values()]),
+        rects([coords(chicken.obj.rect) for chicken in chicken_list]),
+        egg_capacity,
+    )
+    for egg, owner in zip(eggs.values(), owners.tolist()):
+        if owner >= 0:
+            chicken = chicken_list[owner]
+            chicken.eggs.append(egg)
+            egg.chicken = chicken
+
+    return objects, chickens, eggs
+
+
 @final
 class State(QObject):
     image_updated = Signal()
     was_reset = Signal()
-    object_added = Signal(int)
-    object_removed = Signal(int)
+    frame_committed = Signal(SceneDiff)
+    frame_painted = Signal(FrameTimes)
 
     def __init__(self):
         super().__init__()
 
         self.img: Img | None = None
+        # `img` converted once for painting, it does not change with the
+        # shared memory `img` is in
+        self.pixmap: QPixmap | None = None
         self.objects: dict[int, ObjectInfo] = {}
         self.chickens: dict[int, ChickenInfo] = {}
         self.eggs: dict[int, EggInfo] = {}
         self.all_egg_ids: set[int] = set()
+        # Of the frame in `img` until it is painted
+        self.times: FrameTimes | None = None
+
+    def painted(self):
+        if self.times is None:
+            return
+        self.times.painted = time.monotonic()
+        self.frame_painted.emit(self.times)
+        self.times = None
 
     def reset(self):
         self.img = None
+        self.pixmap = None
+        self.times = None
         self.objects = {}
         self.chickens = {}
         self.eggs = {}
         self.all_egg_ids = set()
         self.was_reset.emit()
 
-    def remove_all_objects(self):
-        old_objects = self.objects
-        self.objects = {}
-        self.chickens = {}
-        self.eggs = {}
+    def shown(self, id: int):
+        """What the layers show of the object `id`, to tell whether it changed
+
+        Confidence is rounded as in the labels, only eggs moving or changing
+        of chicken changes the links.
+        """
+        obj = self.objects[id]
+        chicken = self.chickens.get(id)
+        if chicken is not None:
+            eggs = [egg.obj.id for egg in chicken.eggs]
+            return obj.rect, round(obj.confidence, 2), chicken.name, eggs
+        egg = self.eggs[id]
+        if egg.chicken is None:
+            return obj.rect, None
+        return obj.rect, egg.chicken.obj.id, egg.chicken.obj.rect
+
+    def commit(
+        self,
+        objects: dict[int, ObjectInfo],
+        chickens: dict[int, ChickenInfo],
+        eggs: dict[int, EggInfo],
+    ):
+        """Replace the objects with those of a new frame
+
+        Emits `frame_committed` once, with the ids which changed.
+        """
+        old = {id: self.shown(id) for id in self.objects}
+        self.objects = objects
+        self.chickens = chickens
+        self.eggs = eggs
 
-        for id in old_objects:
-            self.object_removed.emit(id)
+        kept = objects.keys() & old.keys()
+        diff = SceneDiff(
+            added=set(objects.keys() - old.keys()),
+            updated={id for id in kept if self.shown(id) != old[id]},
+            removed=set(old.keys() - objects.keys()),
+        )
+        self.frame_committed.emit(diff)
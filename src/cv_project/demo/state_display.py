@@ -5,6 +5,7 @@ from typing import final, override
 from PySide6.QtCore import (
     QPoint,
     QRect,
+    QSize,
 )
 from PySide6.QtGui import (
     QColor,
@@ -12,22 +13,17 @@ from PySide6.QtGui import (
     QPaintEvent,
     QPen,
     QResizeEvent,
+    QStaticText,
     Qt,
     QTransform,
 )
-from PySide6.QtWidgets import (
-    QFrame,
-    QLabel,
-    QVBoxLayout,
-    QWidget,
-)
+from PySide6.QtWidgets import QWidget
 
 from cv_project.demo.detection.schemas import Klass
 
-from .state import State
+from .state import SceneDiff, State
 from .utils import (
     img_size,
-    img_to_pixmap,
     img_width,
 )
 
@@ -168,7 +164,8 @@ class ImageLayer(StateDisplayLayer):
         painter = QPainter(self)
 
         img = self.state.img
-        if img is None:
+        pixmap = self.state.pixmap
+        if img is None or pixmap is None:
             painter.fillRect(self.geometry(), QColor(0, 0, 0))
             return
 
@@ -176,86 +173,83 @@ class ImageLayer(StateDisplayLayer):
         assert img_size(img) == self.size(), f"{img_size(img)} != {self.size()}"
 
         painter.setTransform(self.transform)
-        painter.drawPixmap(QPoint(0, 0), img_to_pixmap(img))
+        painter.drawPixmap(QPoint(0, 0), pixmap)
+        self.state.painted()
 
 
-@dataclass
-class BoxLabel:
-    frame: QFrame
-    info1: QLabel
-    info2: QLabel
+# Label texts kept for reuse, beyond those shown
+MAX_CACHED_LABELS = 1000
+LABEL_MARGIN = 4
+LABEL_BACKGROUND = QColor(255, 255, 255, 128)
 
 
 class LabelsLayer(StateDisplayLayer):
-    def __init__(self, state: State):
-        super().__init__(state)
+    """Draws the labels of all objects in one go
 
-        self.labels: dict[int, BoxLabel] = {}
+    Label texts are laid out once and reused for as long as their content
+    does not change, by any object showing the same text.
+    """
 
-        _ = self.state.object_removed.connect(self.on_removed)
-        _ = self.state.object_added.connect(self.on_added)
-
-    @override
-    def on_transform_updated(self):
-        self.update_positions()
-
-    def update_positions(self):
-        for id, label in self.labels.items():
-            obj = self.obj(id)
-            pos = self.transform.map(obj.rect.topLeft())
-            label.frame.move(pos)
+    def __init__(self, state: State):
+        super().__init__(state)
 
-    def on_removed(self, id: int):
-        old = self.labels.pop(id)
-        if not old:
-            return
-        old.frame.hide()
-        old.frame.deleteLater()
-
-    def on_added(self, id: int):
-        frame = QFrame(self)
-        obj = self.state.objects[id]
-        pos = self.transform.map(obj.rect.topLeft())
-        frame.move(pos)
-        frame.setStyleSheet(
-            "background-color: rgba(255, 255, 255, 128); color: black; font-size: 12px"
-        )
+        font = self.font()
+        font.setPixelSize(12)
+        self.setFont(font)
 
-        layout = QVBoxLayout(frame)
-        layout.setContentsMargins(4, 4, 4, 4)
+        # Text of the label of each object
+        self.labels: dict[int, str] = {}
+        self.texts: dict[str, QStaticText] = {}
 
-        if obj.klass == Klass.Chicken:
-            info1 = QLabel(
-                f"**Confidence**: {round(obj.confidence, 2)}",
-                textFormat=Qt.TextFormat.MarkdownText,
-            )
-        else:
-            info1 = QLabel(f"**ID**: {id}", textFormat=Qt.TextFormat.MarkdownText)
-        info1.setStyleSheet("background-color: transparent;")
-        layout.addWidget(info1)
+        _ = self.state.frame_committed.connect(self.on_committed)
 
-        info2 = QLabel(textFormat=Qt.TextFormat.MarkdownText)
-        info2.setStyleSheet("background-color: transparent;")
-        layout.addWidget(info2)
+    def on_committed(self, diff: SceneDiff):
+        for id in diff.removed:
+            _ = self.labels.pop(id, None)
+        for id in diff.added | diff.updated:
+            self.labels[id] = self.label(id)
 
-        info3 = QLabel(textFormat=Qt.TextFormat.MarkdownText)
-        info3.setStyleSheet("background-color: transparent;")
-        layout.addWidget(info3)
+        if len(self.texts) > MAX_CACHED_LABELS:
+            shown = set(self.labels.values())
+            self.texts = {k: v for k, v in self.texts.items() if k in shown}
+        self.update()
 
-        if obj.klass == Klass.Chicken:
-            info2.show()
-            info2.setText(f"**Eggs**: {len(self.state.chickens[id].eggs)}")
+    def label(self, id: int):
+        obj = self.obj(id)
+        if obj.klass != Klass.Chicken:
+            return f"<b>ID</b>: {id}"
+
+        chicken = self.state.chickens[id]
+        return "<br>".join(
+            [
+                f"<b>Confidence</b>: {round(obj.confidence, 2)}",
+                f"<b>Eggs</b>: {len(chicken.eggs)}",
+                f"<b>Name</b>: {chicken.name}",
+            ]
+        )
 
-            info3.show()
-            info3.setText(f"**Name**: {self.state.chickens[id].name}")
-        else:
-            info2.hide()
-            info3.hide()
+    def text(self, label: str):
+        text = self.texts.get(label)
+        if text is None:
+            text = QStaticText(label)
+            text.setTextFormat(Qt.TextFormat.RichText)
+            text.setPerformanceHint(QStaticText.PerformanceHint.AggressiveCaching)
+            text.prepare(QTransform(), self.font())
+            self.texts[label] = text
+        return text
 
-        frame.adjustSize()
-        frame.show()
+    @override
+    def paintEvent(self, event: QPaintEvent):
+        painter = QPainter(self)
+        painter.setPen(QColor(0, 0, 0))
 
-        self.labels[id] = BoxLabel(frame=frame, info1=info1, info2=info2)
+        for id, label in self.labels.items():
+            text = self.text(label)
+            pos = self.transform.map(self.obj(id).rect.topLeft())
+            margins = QSize(2 * LABEL_MARGIN, 2 * LABEL_MARGIN)
+            background = QRect(pos, text.size().toSize() + margins)
+            painter.fillRect(background, LABEL_BACKGROUND)
+            painter.drawStaticText(pos + QPoint(LABEL_MARGIN, LABEL_MARGIN), text)
 
 
 @dataclass
@@ -270,25 +264,26 @@ class BoxesLayer(StateDisplayLayer):
         super().__init__(state)
         # self.setAttribute(Qt.WidgetAttribute.WA_TranslucentBackground)
 
-        _ = self.state.object_removed.connect(self.on_removed)
-        _ = self.state.object_added.connect(self.on_added)
+        _ = self.state.frame_committed.connect(self.on_committed)
 
         self.boxes: dict[int, BoxDisplayInfo] = {}
         self.box_width = 4
 
-    def on_removed(self, id: int):
-        _ = self.boxes.pop(id, None)
+    def on_committed(self, diff: SceneDiff):
+        for id in diff.removed:
+            _ = self.boxes.pop(id, None)
+        for id in diff.added | diff.updated:
+            self.boxes[id] = self.box(id)
         self.update()
 
-    def on_added(self, id: int):
+    def box(self, id: int):
         obj = self.obj(id)
         if obj.klass is Klass.Chicken:
             color = QColor(50, 255, 50)
         else:
             color = QColor(50, 50, 255)
 
-        self.boxes[id] = BoxDisplayInfo(obj.rect, color)
-        self.update()
+        return BoxDisplayInfo(obj.rect, color)
 
     @override
     def paintEvent(self, event: QPaintEvent):
@@ -315,30 +310,35 @@ class ConnectionLayer(StateDisplayLayer):
     def __init__(self, state: State):
         super().__init__(state)
 
-        _ = self.state.object_removed.connect(self.on_removed)
-        _ = self.state.object_added.connect(self.on_added)
+        _ = self.state.frame_committed.connect(self.on_committed)
 
         self.links: dict[int, ConnectionDisplayInfo] = {}
         self.line_width = 3
 
-    def on_removed(self, id: int):
-        _ = self.links.pop(id, None)
+    def on_committed(self, diff: SceneDiff):
+        for id in diff.removed:
+            _ = self.links.pop(id, None)
+        for id in diff.added | diff.updated:
+            link = self.link(id)
+            if link is None:
+                _ = self.links.pop(id, None)
+            else:
+                self.links[id] = link
         self.update()
 
-    def on_added(self, id: int):
+    def link(self, id: int):
         obj = self.obj(id)
         if obj.klass is Klass.Chicken:
-            return
+            return None
         egg = self.state.eggs[id]
         if egg.chicken is None:
-            return
+            return None
 
         color = QColor(50, 50, 255)
 
-        self.links[id] = ConnectionDisplayInfo(
+        return ConnectionDisplayInfo(
             obj.rect.center(), egg.chicken.obj.rect.center(), color
         )
-        self.update()
 
     @override
     def paintEvent(self, event: QPaintEvent):
@@ -3,12 +3,49 @@ from ultralytics import YOLO
 import math
 import yt_dlp
 import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import numpy as np
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from queue import Empty, Full, Queue
 
 '''
-Given a youtube video link, detect objects using the pretrained model, 
+Given a youtube video link, detect objects using the pretrained model,
 display the results in real-time, and output a .mp4 file with the results.
+
+With --offline, the video is instead split into segments which are detected
+in parallel worker processes, without displaying anything.
+
+With --pipelined, nothing is displayed either and decoding, detection and
+drawing plus encoding run at the same time in three threads.
 '''
 
+MODEL_PATH = "runs/detect/train3/weights/best.pt"
+VIDEO_URL = "https://www.youtube.com/watch?v=70IqKloH-mw&pp=ygUNY2hpY2tlbiB2aWRlbw%3D%3D"
+OUTPUT_FILENAME = "chicken_egg_detection.mp4"
+
+# --- Classnames the model can currently detect
+classNames = ["chicken", "egg"]
+
+font = cv2.FONT_HERSHEY_SIMPLEX
+fontScale = 0.9
+color = (0, 255, 0)
+thickness = 2
+
+# --- Offline mode: frames detected twice, at the end of a segment and the
+# start of the next one, to match up their track ids
+OVERLAP_FRAMES = 30
+# --- Boxes of two segments in the same frame are the same object above this IoU
+STITCH_IOU = 0.5
+
+# --- Pipelined mode: frames waiting between two stages, at most
+QUEUE_SIZE = 8
+
+
 # --- Download video
 def download_video(video_url):
     filename = "video.mp4"
@@ -29,65 +66,59 @@ def download_video(video_url):
 
     return filename
 
-# --- Load the best pretrained model
-model = YOLO("runs/detect/train3/weights/best.pt")
 
-video_url = "https://www.youtube.com/watch?v=70IqKloH-mw&pp=ygUNY2hpY2tlbiB2aWRlbw%3D%3D"
-video_path = download_video(video_url)
+def open_video(video_path):
+    cap = cv2.VideoCapture(video_path)
+    assert cap.isOpened(), f"Error reading video file at: {video_path}"
+    return cap
 
-# --- Open video
-cap = cv2.VideoCapture(video_path)
-assert cap.isOpened(), f"Error reading video file at: {video_path}"
 
-# --- Classnames the model can currently detect
-classNames = ["chicken", "egg"]
+def video_writer(output_filename, fps, width, height):
+    return cv2.VideoWriter(output_filename,
+                           cv2.VideoWriter_fourcc(*'avc1'), # 'avc1' is H.264, very compatible
+                           fps,
+                           (width, height))
 
-# --- Video Writer
-width, height, fps = (int(cap.get(x)) for x in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT, cv2.CAP_PROP_FPS))
-output_filename = "chicken_egg_detection.mp4"
-video_writer = cv2.VideoWriter(output_filename,
-                               cv2.VideoWriter_fourcc(*'avc1'), # 'avc1' is H.264, very compatible
-                               fps,
-                               (width, height))
 
-font = cv2.FONT_HERSHEY_SIMPLEX
-fontScale = 0.9
-color = (0, 255, 0)
-thickness = 2
+def video_props(cap):
+    width, height, fps = (int(cap.get(x)) for x in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT, cv2.CAP_PROP_FPS))
+    return width, height, fps
+
+
+# --- Boxes of a tracking result: x1, y1, x2, y2, id, confidence, class
+def tracked_boxes(result):
+    if result.boxes is None:
+        return np.empty((0, 7), dtype=np.float32)
+    data = result.boxes.data.cpu().numpy().astype(np.float32)
+    if not result.boxes.is_track:
+        # --- No tracks yet: id -1
+        data = np.insert(data, 4, -1, axis=1)
+    return data
 
-while cap.isOpened():
-    success, img = cap.read()
-    if not success:
-        print("End of video or error reading frame.")
-        break
-    
-    results = model.track(img, persist=True, show=False, verbose=False)
 
+def annotate(img, boxes):
     chicken_count = 0
     egg_count = 0
 
-    # Get the boxes and track IDs
-    # Check if there are any detections in the current frame
-    if results[0].boxes is not None:
-        boxes = results[0].boxes
-        for box in boxes:
-            confidence = math.ceil((box.conf[0] * 100)) / 100
-
-            if confidence > 0.70: 
-                # --- Detect bounding boxes
-                x1, y1, x2, y2 = map(int, box.xyxy[0])
-                cv2.rectangle(img, (x1, y1), (x2, y2), (255, 0, 255), 3)
-                
-                cls_index = int(box.cls[0])
-                className = classNames[cls_index]
-                
-                label = f"{className} {confidence}"
-                cv2.putText(img, label, (x1, y1 - 10), font, 0.8, color, thickness)
-                
-                if className == "chicken":
-                    chicken_count += 1
-                elif className == "egg":
-                    egg_count += 1
+    for x1, y1, x2, y2, track_id, conf, cls in boxes:
+        confidence = math.ceil((conf * 100)) / 100
+
+        if confidence > 0.70:
+            # --- Detect bounding boxes
+            x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+            cv2.rectangle(img, (x1, y1), (x2, y2), (255, 0, 255), 3)
+
+            className = classNames[int(cls)]
+
+            label = f"{className} {confidence}"
+            if track_id >= 0:
+                label = f"{className} #{int(track_id)} {confidence}"
+            cv2.putText(img, label, (x1, y1 - 10), font, 0.8, color, thickness)
+
+            if className == "chicken":
+                chicken_count += 1
+            elif className == "egg":
+                egg_count += 1
 
     # --- Display counts on the frame (cleaner top-left placement) ---
     text_chicken = f"Chicken Count: {chicken_count}"
@@ -95,20 +126,415 @@ while cap.isOpened():
     cv2.putText(img, text_chicken, (20, 40), font, fontScale, color, thickness)
     cv2.putText(img, text_eggs, (20, 80), font, fontScale, color, thickness)
 
-    # --- To display the processed video in window
-    cv2.imshow("YOLOv8 Live Detection", img)
 
-    # --- Write the frame to the output file
-    video_writer.write(img)
+def run_interactive(model_path, video_path, output_filename):
+    # --- Load the best pretrained model
+    model = YOLO(model_path)
+
+    # --- Open video
+    cap = open_video(video_path)
+
+    # --- Video Writer
+    width, height, fps = video_props(cap)
+    writer = video_writer(output_filename, fps, width, height)
+
+    while cap.isOpened():
+        success, img = cap.read()
+        if not success:
+            print("End of video or error reading frame.")
+            break
+
+        results = model.track(img, persist=True, show=False, verbose=False)
+        annotate(img, tracked_boxes(results[0]))
+
+        # --- To display the processed video in window
+        cv2.imshow("YOLOv8 Live Detection", img)
+
+        # --- Write the frame to the output file
+        writer.write(img)
+
+        # --- Press Q to quit
+        if cv2.waitKey(1) & 0xFF == ord("q"):
+            print("Exiting...")
+            break
+
+    # --- Kill everything on exit
+    cap.release()
+    writer.release()
+    cv2.destroyAllWindows()
+
+
+# --- Pipelined mode
+
+def run_pipelined(model_path, video_path, output_filename, queue_size=QUEUE_SIZE):
+    """Decode, detect and draw + encode in three threads, with bounded queues between them
+
+    Prints how busy each stage was, the busiest one limits the throughput.
+    """
+    model = YOLO(model_path)
+    cap = open_video(video_path)
+    width, height, fps = video_props(cap)
+    writer = video_writer(output_filename, fps, width, height)
+
+    decoded = Queue(queue_size)
+    detected = Queue(queue_size)
+    # --- Seconds each stage spent working, not waiting for a queue
+    busy = {"decode": 0.0, "detect": 0.0, "encode": 0.0}
+    # --- A failing stage stops the others, its error is raised at the end
+    errors = []
+    stop = threading.Event()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except Empty:
+                pass
+        return None
+
+    def fail(exc):
+        errors.append(exc)
+        stop.set()
+
+    def decode():
+        try:
+            while True:
+                start = time.perf_counter()
+                success, img = cap.read()
+                busy["decode"] += time.perf_counter() - start
+                if not success or not put(decoded, img):
+                    break
+        except Exception as exc:
+            fail(exc)
+        finally:
+            put(decoded, None)
+
+    def encode():
+        try:
+            while (item := get(detected)) is not None:
+                img, boxes = item
+                start = time.perf_counter()
+                annotate(img, boxes)
+                writer.write(img)
+                busy["encode"] += time.perf_counter() - start
+        except Exception as exc:
+            fail(exc)
+
+    threads = [
+        threading.Thread(target=decode, daemon=True),
+        threading.Thread(target=encode, daemon=True),
+    ]
+    wall_start = time.perf_counter()
+    for t in threads:
+        t.start()
+
+    # --- The model runs on this thread
+    frames = 0
+    try:
+        while (img := get(decoded)) is not None:
+            start = time.perf_counter()
+            results = model.track(img, persist=True, show=False, verbose=False)
+            boxes = tracked_boxes(results[0])
+            busy["detect"] += time.perf_counter() - start
+            if not put(detected, (img, boxes)):
+                break
+            frames += 1
+    except Exception as exc:
+        fail(exc)
+    finally:
+        put(detected, None)
+
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - wall_start
+    cap.release()
+    writer.release()
+    if errors:
+        raise errors[0]
+
+    print(f"{frames} frames in {wall:.1f}s, {frames / max(wall, 1e-9):.1f} fps")
+    for name, seconds in busy.items():
+        per_frame = 1000 * seconds / max(frames, 1)
+        print(f"{name}: {100 * seconds / max(wall, 1e-9):.0f}% busy, {per_frame:.1f}ms per frame")
+    return busy, wall
+
+
+# --- Offline mode
+
+def keyframes(video_path, fps):
+    """Numbers of the keyframes in display order, seeking to them decodes nothing extra
+
+    Only the keyframes are decoded, for their timestamps. None without ffprobe
+    """
+    if shutil.which("ffprobe") is None:
+        return None
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey",
+         "-show_frames", "-show_entries", "frame=best_effort_timestamp_time",
+         "-of", "csv=p=0", video_path],
+        capture_output=True, text=True, check=True,
+    ).stdout
+    times = [float(t) for t in out.split() if t != "N/A"]
+    if not times:
+        return None
+    # --- OpenCV numbers frames by their timestamp, from the first one on
+    first = min(times)
+    return sorted({round((t - first) * fps) for t in times})
+
+
+def segment_starts(video_path, frame_count, fps, segments):
+    """First frames of about equally long segments, moved to keyframes if known"""
+    starts = [frame_count * i // segments for i in range(segments)]
+    keys = keyframes(video_path, fps)
+    if keys:
+        keys = np.array(keys)
+        starts = [int(keys[np.abs(keys - s).argmin()]) for s in starts]
+    starts[0] = 0
+    return sorted(set(starts))
+
+
+def read_frames(cap, start, end):
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    for _ in range(start, end):
+        success, img = cap.read()
+        if not success:
+            return
+        yield img
+
+
+def limit_threads(threads):
+    """Let a worker process use `threads` cores, instead of all of them"""
+    import torch
+
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+
+
+def save_boxes(path, boxes):
+    np.savez(path, *boxes)
+
+
+def load_boxes(path):
+    with np.load(path) as f:
+        return [f[f"arr_{i}"] for i in range(len(f.files))]
+
+
+def track_segment(model_path, video_path, first, end, overlap, boxes_path):
+    """Track the frames from `first` to `end`, saving their boxes to `boxes_path`
+
+    Returns what `global_ids` needs: the track ids, the boxes of the `overlap`
+    first frames and of the last `OVERLAP_FRAMES` frames.
+    """
+    model = YOLO(model_path)
+    cap = open_video(video_path)
+    res = []
+    for img in read_frames(cap, first, end):
+        results = model.track(img, persist=True, show=False, verbose=False)
+        res.append(tracked_boxes(results[0]))
+    cap.release()
+    save_boxes(boxes_path, res)
+    print(f"Tracked frames {first} to {end}")
+
+    ids = sorted({int(i) for b in res for i in b[:, 4] if i >= 0})
+    return ids, res[:overlap], res[max(0, len(res) - OVERLAP_FRAMES):]
+
+
+def iou(a, b):
+    """IoU of each box in `a` with each in `b`"""
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+def matched_ids(before, after):
+    """Ids in `after` mapped to ids in `before`, for the same frames of two segments
+
+    A pair of ids gets a vote for each frame in which their boxes overlap the most,
+    pairs with the most votes are matched first.
+    """
+    votes = {}
+    for a, b in zip(before, after):
+        a = a[a[:, 4] >= 0]
+        b = b[b[:, 4] >= 0]
+        if len(a) == 0 or len(b) == 0:
+            continue
+        overlap = iou(a, b)
+        for j in range(len(b)):
+            i = int(overlap[:, j].argmax())
+            if overlap[i, j] > STITCH_IOU and a[i, 6] == b[j, 6]:
+                pair = (int(a[i, 4]), int(b[j, 4]))
+                votes[pair] = votes.get(pair, 0) + 1
+
+    res = {}
+    used = set()
+    for (id_a, id_b), _ in sorted(votes.items(), key=lambda x: -x[1]):
+        if id_b not in res and id_a not in used:
+            res[id_b] = id_a
+            used.add(id_a)
+    return res
+
+
+def global_ids(segments):
+    """Ids unique across the video for the track ids of each segment
+
+    `segments[k]` is what `track_segment` returns: the first frames of segment k
+    are also the last frames of segment k - 1. Tracks continuing over a boundary
+    keep their id.
+    """
+    res = []
+    next_id = 0
+    prev_global = {}
+    prev_tail = None
+    for ids, head, tail in segments:
+        matched = {}
+        if prev_tail is not None and head:
+            n = min(len(head), len(prev_tail))
+            matched = matched_ids(prev_tail[len(prev_tail) - n:], head[len(head) - n:])
+
+        to_global = {}
+        for local in ids:
+            if local in matched and matched[local] in prev_global:
+                to_global[local] = prev_global[matched[local]]
+            else:
+                to_global[local] = next_id
+                next_id += 1
+
+        res.append(to_global)
+        prev_tail = tail
+        prev_global = to_global
+    return res
+
+
+def with_ids(boxes, to_global):
+    """Copy of `boxes` with the track ids replaced"""
+    boxes = boxes.copy()
+    for row in boxes:
+        if row[4] >= 0:
+            row[4] = to_global[int(row[4])]
+    return boxes
+
+
+def write_segment(video_path, start, boxes_path, overlap, to_global, output_filename):
+    """Draw the tracks from `start` on, the overlap is part of the previous segment
+
+    Decodes the frames again: the ids drawn on them are only known once all
+    segments are tracked.
+    """
+    boxes = load_boxes(boxes_path)[overlap:]
+    cap = open_video(video_path)
+    width, height, fps = video_props(cap)
+    writer = video_writer(output_filename, fps, width, height)
+    for img, b in zip(read_frames(cap, start, start + len(boxes)), boxes):
+        annotate(img, with_ids(b, to_global))
+        writer.write(img)
+    cap.release()
+    writer.release()
+    return output_filename
+
+
+def concatenate(segment_files, output_filename):
+    """Join encoded segments, without re-encoding if ffmpeg is there"""
+    if shutil.which("ffmpeg") is not None:
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+            for name in segment_files:
+                f.write(f"file '{os.path.abspath(name)}'\n")
+        subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-f", "concat", "-safe", "0",
+             "-i", f.name, "-c", "copy", output_filename],
+            check=True,
+        )
+        os.remove(f.name)
+        return
+
+    print("ffmpeg not found: re-encoding the segments")
+    cap = open_video(segment_files[0])
+    width, height, fps = video_props(cap)
+    cap.release()
+    writer = video_writer(output_filename, fps, width, height)
+    for name in segment_files:
+        cap = open_video(name)
+        while True:
+            success, img = cap.read()
+            if not success:
+                break
+            writer.write(img)
+        cap.release()
+    writer.release()
+
+
+def run_offline(model_path, video_path, output_filename, workers):
+    cap = open_video(video_path)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+
+    starts = segment_starts(video_path, frame_count, fps, workers)
+    ends = starts[1:] + [frame_count]
+    # --- Each segment but the first is also tracked over the end of the one before
+    firsts = [max(0, s - OVERLAP_FRAMES) if k > 0 else 0 for k, s in enumerate(starts)]
+    overlaps = [s - f for s, f in zip(starts, firsts)]
+    print(f"Processing {frame_count} frames in {len(starts)} segments with {workers} workers")
+
+    # --- Boxes stay in files, the workers only send what matches the tracks up
+    out_dir = tempfile.mkdtemp()
+    boxes_paths = [os.path.join(out_dir, f"boxes{k}.npz") for k in range(len(starts))]
+    names = [os.path.join(out_dir, f"segment{k}.mp4") for k in range(len(starts))]
+
+    # --- Workers share the cores
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with Pool(workers, initializer=limit_threads, initargs=(threads,)) as pool:
+        segments = pool.starmap(
+            track_segment,
+            [(model_path, video_path, f, e, o, p)
+             for f, e, o, p in zip(firsts, ends, overlaps, boxes_paths)],
+        )
+        ids = global_ids(segments)
+        del segments
+
+        segment_files = pool.starmap(
+            write_segment,
+            [(video_path, s, p, o, i, n)
+             for s, p, o, i, n in zip(starts, boxes_paths, overlaps, ids, names)],
+        )
+
+    concatenate(segment_files, output_filename)
+    shutil.rmtree(out_dir)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--video", help="Video file, downloaded from the default url if not given")
+    parser.add_argument("--output", default=OUTPUT_FILENAME)
+    parser.add_argument("--offline", action="store_true", help="No display, split across processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--pipelined", action="store_true", help="No display, stages in threads")
+    args = parser.parse_args()
+
+    video_path = args.video or download_video(VIDEO_URL)
+    if args.offline:
+        run_offline(args.model, video_path, args.output, args.workers)
+    elif args.pipelined:
+        run_pipelined(args.model, video_path, args.output)
+    else:
+        run_interactive(args.model, video_path, args.output)
 
-    # --- Press Q to quit
-    if cv2.waitKey(1) & 0xFF == ord("q"):
-        print("Exiting...")
-        break
+    print(f"Video processing complete. Output saved to: {args.output}")
 
-# --- Kill everything on exit
-cap.release()
-video_writer.release()
-cv2.destroyAllWindows()
 
-print(f"Video processing complete. Output saved to: {output_filename}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
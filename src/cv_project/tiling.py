@@ -0,0 +1,71 @@
+"""Detecting large images as overlapping tiles, for the demo and training"""
+
+import numpy as np
+from numpy.typing import NDArray
+
+# x1, y1, x2, y2
+Rect = tuple[int, int, int, int]
+
+
+def tile_rects(rect: Rect, grid: tuple[int, int], overlap: float = 0.2) -> list[Rect]:
+    """Split `rect` into columns and rows of tiles overlapping by `overlap`
+
+    `overlap` is a fraction of the tile size.
+    """
+    x1, y1, x2, y2 = rect
+    cols, rows = grid
+
+    def spans(start: int, end: int, n: int):
+        size = (end - start) / (n - (n - 1) * overlap)
+        step = size * (1 - overlap)
+        return [
+            (start + round(i * step), min(end, start + round(i * step + size)))
+            for i in range(n)
+        ]
+
+    return [
+        (tx1, ty1, tx2, ty2)
+        for ty1, ty2 in spans(y1, y2, max(1, rows))
+        for tx1, tx2 in spans(x1, x2, max(1, cols))
+    ]
+
+
+def merge_boxes(
+    boxes: NDArray[np.float32],
+    tiles: NDArray[np.int64] | None = None,
+    threshold: float = 0.5,
+) -> NDArray[np.float32]:
+    """Drop boxes mostly covered by a more confident box of the same class
+    from another tile
+
+    `boxes` are x1, y1, x2, y2, confidence, class and `tiles` the tile each
+    one was found in, all different if None. Boxes cut at a tile border are
+    a part of the box detected in the neighbouring tile, so the overlap is
+    relative to the smaller box. Boxes of the same tile went through the
+    model's NMS already, touching objects are not merged. As in Fast NMS,
+    suppressed boxes still suppress others, which keeps this a few matrix
+    operations.
+    """
+    if len(boxes) < 2:
+        return boxes
+    if tiles is None:
+        tiles = np.arange(len(boxes))
+
+    order = np.argsort(-boxes[:, 4], kind="stable")
+    boxes = boxes[order]
+    tiles = tiles[order]
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    area = (x2 - x1) * (y2 - y1)
+
+    iw = np.minimum(x2[:, None], x2) - np.maximum(x1[:, None], x1)
+    ih = np.minimum(y2[:, None], y2) - np.maximum(y1[:, None], y1)
+    inter = iw.clip(0) * ih.clip(0)
+    smaller = np.minimum(area[:, None], area).clip(1e-6)
+    overlap = inter / smaller
+    overlap[boxes[:, 5][:, None] != boxes[:, 5]] = 0
+    overlap[tiles[:, None] == tiles] = 0
+
+    # Only more confident boxes suppress
+    overlap = np.triu(overlap, k=1)
+    keep = overlap.max(axis=0) < threshold
+    return boxes[keep]
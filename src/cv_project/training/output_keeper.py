@@ -41,9 +41,9 @@ class Store:
         eprint(f"{path}: hashing external file")
 
         with path.open("rb", buffering=0) as f:
-            digest = file_digest(f, "sha256").digest()
+            digest = file_digest(f, "sha256")
             return self.hash_object(
-                {"external": str(path.absolute()), "digest": digest}
+                {"external": str(path.absolute()), "digest": digest.hex()}
             )
 
     def hash_object(self, obj: object) -> bytes:
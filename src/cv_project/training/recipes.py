@@ -14,6 +14,7 @@ from .recipe_utils import (
     lines,
     output,
     run_prediction,
+    run_tiled_prediction,
 )
 from .recipe_utils import (
     download_video_sample as download_video_sample,
@@ -262,6 +263,13 @@ def test(*, model: Path, split: str = "test"):
     )
 
 
+def test_tiled(*, model: Path, grid: tuple[int, int] = (2, 2), split: str = "test"):
+    data = prepared_data_with_groups
+    return run_tiled_prediction(
+        model / "train/weights/best.pt", images=data / f"images/{split}", grid=grid
+    )
+
+
 def make(expr: str, dry: bool = False, trace: bool = False):
     no_compute = output.no_compute
     trace_hashing = output.trace_hashing
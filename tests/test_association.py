@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from cv_project.demo.detection.association import associate, rect_distances, rects
+
+
+def random_rects(rng: np.random.Generator, n: int, x: int, y: int, span: int):
+    xy = rng.integers(0, span, (n, 2)) + (x, y)
+    wh = rng.integers(5, 80, (n, 2))
+    return rects([(x1, y1, x1 + w, y1 + h) for (x1, y1), (w, h) in zip(xy, wh)])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_grid_matches_all_pairs(seed: int):
+    rng = np.random.default_rng(seed)
+    eggs = random_rects(rng, 300, 0, 0, 2000)
+    chickens = random_rects(rng, 200, 0, 0, 2000)
+    expected = np.argmin(rect_distances(eggs, chickens), axis=1)
+    for cell in (7, 50, 160, 1000):
+        assert (associate(eggs, chickens, cell=cell) == expected).all()
+    assert (associate(eggs, chickens, cell=rng.uniform(1, 500)) == expected).all()
+
+
+def test_grid_without_nearby_chickens():
+    rng = np.random.default_rng(0)
+    # Over `GRID_MIN_PAIRS`, with all chickens far from all eggs
+    eggs = random_rects(rng, 1100, 0, 0, 500)
+    chickens = random_rects(rng, 1100, 50_000, 50_000, 500)
+    expected = np.argmin(rect_distances(eggs, chickens), axis=1)
+    assert (associate(eggs, chickens) == expected).all()
+
+
+def test_empty():
+    chickens = rects([(0, 0, 10, 10)])
+    assert len(associate(rects([]), chickens)) == 0
+    assert (associate(chickens, rects([])) == -1).all()
@@ -0,0 +1,47 @@
+import pytest
+
+from cv_project.demo.detection.latency import LatencyStats
+from cv_project.demo.detection.schemas import FrameTimes
+
+
+def test_stages():
+    stats = LatencyStats()
+    stats.add(FrameTimes(read=1.0, captured=1.002, preprocessed=1.003, inferred=1.013))
+    res = stats.percentiles()
+    assert res.keys() == {"captured", "preprocessed", "inferred", "total"}
+    assert res["captured"] == pytest.approx((2, 2, 2))
+    assert res["inferred"] == pytest.approx((10, 10, 10))
+    assert res["total"] == pytest.approx((13, 13, 13))
+
+
+def test_skipped_stage():
+    # Not detected: the time goes to the next stage
+    stats = LatencyStats()
+    stats.add(FrameTimes(read=1.0, captured=1.002, tracked=1.005))
+    res = stats.percentiles()
+    assert "inferred" not in res
+    assert res["tracked"] == pytest.approx((3, 3, 3))
+
+
+def test_percentiles():
+    stats = LatencyStats()
+    for ms in range(1, 101):
+        stats.add(FrameTimes(read=1.0, captured=1.0 + ms / 1000))
+    p50, p95, p99 = stats.percentiles()["captured"]
+    assert p50 == pytest.approx(50.5)
+    assert p95 == pytest.approx(95.05)
+    assert p99 == pytest.approx(99.01)
+
+
+def test_window():
+    stats = LatencyStats(window=10)
+    for ms in [1000] * 10 + [1] * 10:
+        stats.add(FrameTimes(read=1.0, captured=1.0 + ms / 1000))
+    assert stats.percentiles()["captured"] == pytest.approx((1, 1, 1))
+
+
+def test_empty():
+    stats = LatencyStats()
+    assert stats.percentiles() == {}
+    stats.add(FrameTimes(read=1.0))
+    assert stats.percentiles() == {}
@@ -0,0 +1,50 @@
+import numpy as np
+
+from cv_project.demo.detection.motion import MotionGate, thumbnail
+
+
+def frame(level: int):
+    return np.full((480, 640, 3), level, dtype=np.uint8)
+
+
+def test_thumbnail():
+    small = thumbnail(frame(30))
+    assert small.shape == (48, 64)
+    assert (small == 30).all()
+
+
+def test_first_frame_passes():
+    assert MotionGate(10, 30).changed(frame(0))
+
+
+def test_threshold():
+    gate = MotionGate(10, 30)
+    assert gate.changed(frame(0))
+    assert not gate.changed(frame(10))
+    assert gate.changed(frame(11))
+    assert gate.skips == 1
+
+
+def test_compared_with_last_passed():
+    # Slow changes add up
+    gate = MotionGate(10, 30)
+    assert gate.changed(frame(0))
+    assert not gate.changed(frame(6))
+    assert gate.changed(frame(12))
+    assert not gate.changed(frame(18))
+
+
+def test_max_skips():
+    gate = MotionGate(10, 3)
+    passed = [gate.changed(frame(0)) for _ in range(9)]
+    assert passed == [True, False, False, False, True, False, False, False, True]
+    assert gate.skips == 6
+
+
+def test_zero_threshold():
+    gate = MotionGate(0, 30)
+    assert gate.changed(frame(0))
+    assert not gate.changed(frame(0))
+    img = frame(0)
+    img[0, 0] = 255
+    assert gate.changed(img)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("ultralytics")
+
+from cv_project.demo.detection.regions import Region  # noqa: E402
+from cv_project.demo.detection.schemas import rect_roi  # noqa: E402
+
+WIDTH, HEIGHT = 640, 480
+
+
+def box(x1: float, y1: float, x2: float, y2: float):
+    return np.array([[x1, y1, x2, y2, 0.9, 0]], dtype=np.float32)
+
+
+def test_whole_frame():
+    region = Region(rect_roi(0, 0, 1, 1), WIDTH, HEIGHT)
+    assert (region.x1, region.y1, region.x2, region.y2) == (0, 0, WIDTH, HEIGHT)
+    assert region.tiles == [(0, 0, WIDTH, HEIGHT)]
+    img = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    assert region.crops(img)[0].shape == img.shape
+
+
+def test_clamped_to_frame():
+    region = Region(rect_roi(-0.5, 0.5, 1.5, 2), WIDTH, HEIGHT)
+    assert (region.x1, region.y1, region.x2, region.y2) == (0, 240, WIDTH, HEIGHT)
+
+
+def test_thin():
+    # At least a pixel wide
+    region = Region(rect_roi(0.5, 0, 0.5, 1), WIDTH, HEIGHT)
+    assert (region.x1, region.x2) == (320, 321)
+
+
+@pytest.mark.parametrize("roi", [rect_roi(1.2, 0, 2, 1), rect_roi(0, -1, 1, -0.5)])
+def test_outside_frame(roi: list[tuple[float, float]]):
+    with pytest.raises(ValueError):
+        _ = Region(roi, WIDTH, HEIGHT)
+
+
+def test_to_frame():
+    region = Region(rect_roi(0.5, 0.5, 1, 1), WIDTH, HEIGHT, grid=(2, 1), overlap=0)
+    assert region.tiles == [(320, 240, 480, 480), (480, 240, 640, 480)]
+    boxes, tiles = region.to_frame([box(10, 20, 30, 40), box(0, 0, 10, 10)])
+    assert boxes[:, :4].tolist() == [[330, 260, 350, 280], [480, 240, 490, 250]]
+    assert tiles.tolist() == [0, 1]
+
+
+def test_to_frame_polygon():
+    # The lower left half of the frame
+    triangle = [(0.0, 0.0), (1.0, 1.0), (0.0, 1.0)]
+    region = Region(triangle, WIDTH, HEIGHT)
+    below = box(100, 300, 140, 340)
+    above = box(500, 100, 540, 140)
+    boxes, tiles = region.to_frame([np.concatenate([below, above])])
+    assert boxes.tolist() == below.tolist()
+    assert tiles.tolist() == [0]
@@ -0,0 +1,57 @@
+import pytest
+
+from cv_project.demo.detection.resolution import (
+    DEFAULT_SIZE,
+    MAX_SIZE,
+    MIN_SIZE,
+    SETTLE_FRAMES,
+    Resolution,
+)
+
+
+def run(res: Resolution, ms: float, frames: int = SETTLE_FRAMES):
+    for _ in range(frames):
+        res.update(ms)
+    return res.size
+
+
+def test_square():
+    assert Resolution().imgsz(1280, 720) == (DEFAULT_SIZE, DEFAULT_SIZE)
+
+
+@pytest.mark.parametrize(
+    "width, height, imgsz", [(1280, 720, (384, 640)), (720, 1280, (640, 384))]
+)
+def test_rect(width: int, height: int, imgsz: tuple[int, int]):
+    assert Resolution(rect=True).imgsz(width, height) == imgsz
+
+
+def test_without_target():
+    assert run(Resolution(), 1000) == DEFAULT_SIZE
+
+
+def test_settles_first():
+    res = Resolution(target_ms=10)
+    assert run(res, 20, SETTLE_FRAMES - 1) == DEFAULT_SIZE
+    assert run(res, 20, 1) < DEFAULT_SIZE
+
+
+def test_step_down():
+    res = Resolution(target_ms=10)
+    # The area goes down with the time, to 80% of the target
+    assert run(res, 20) == 416
+    assert res.avg_ms is None and res.frames == 0
+
+
+def test_step_up():
+    assert run(Resolution(target_ms=10), 4) == 896
+
+
+@pytest.mark.parametrize("ms", [8, 9, 10])
+def test_kept_within_headroom(ms: float):
+    assert run(Resolution(target_ms=10), ms, 5 * SETTLE_FRAMES) == DEFAULT_SIZE
+
+
+def test_limits():
+    assert run(Resolution(target_ms=10), 1000) == MIN_SIZE
+    assert run(Resolution(target_ms=10), 0.1) == MAX_SIZE
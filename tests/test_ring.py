@@ -0,0 +1,200 @@
+import threading
+import time
+from typing import Callable, cast, override
+
+import pytest
+
+from cv_project.demo.detection.process_utils import Source
+from cv_project.demo.detection.ring import Ring, SlotState
+from cv_project.demo.detection.schemas import DropPolicy
+from cv_project.demo.utils import Img
+
+
+class CountingSource(Source):
+    """`count` frames, each filled with its number
+
+    With `gated`, each frame waits for `allow`, like a camera.
+    """
+
+    def __init__(self, count: int, gated: bool = False):
+        self.count: int = count
+        self.frame: int = -1
+        self.gate: threading.Semaphore | None = (
+            threading.Semaphore(0) if gated else None
+        )
+
+    def allow(self, frames: int):
+        assert self.gate is not None
+        self.gate.release(frames)
+
+    @override
+    def read(self, img: Img) -> bool:
+        if self.gate is not None:
+            _ = self.gate.acquire()
+        if self.frame + 1 >= self.count:
+            return False
+        self.frame += 1
+        img[:] = self.frame
+        return True
+
+    @override
+    def size(self):
+        return 8, 4
+
+    @override
+    def position(self):
+        return self.frame
+
+
+@pytest.fixture
+def mk_ring():
+    rings: list[Ring] = []
+
+    def mk(
+        count: int, depth: int = 3, policy: DropPolicy = "block", gated: bool = False
+    ):
+        ring = Ring(CountingSource(count, gated), depth, policy, lambda: None)
+        rings.append(ring)
+        ring.start()
+        return ring
+
+    yield mk
+    for ring in rings:
+        src = cast(CountingSource, ring.src)
+        if src.gate is not None:
+            # Let the capture thread find the end of the source
+            src.allow(src.count + 1)
+        ring.close()
+
+
+def wait_until(ring: Ring, cond: Callable[[], bool]):
+    deadline = time.monotonic() + 5
+    while True:
+        with ring.cond:
+            if cond():
+                return
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def stalled(ring: Ring):
+    return lambda: ring.capture_stats.stalled > 0
+
+
+def send_next(ring: Ring):
+    """Detect and send the next frame, returns its number"""
+    objs = ring.take_captured(1, wait_for_batch=False)
+    ring.detected(objs, True)
+    o = ring.next_ready()
+    assert o is not None
+    return o
+
+
+def test_lifecycle(mk_ring):
+    ring = mk_ring(2)
+    wait_until(ring, lambda: ring.capture_done)
+    assert [o.state for o in ring.images].count(SlotState.CAPTURED) == 2
+    assert ring.next_ready() is None
+
+    objs = ring.take_captured(2, wait_for_batch=False)
+    assert [o.seq for o in objs] == [0, 1]
+    assert all(o.state == SlotState.DETECTING for o in objs)
+    assert ring.take_captured(2, wait_for_batch=False) == []
+
+    ring.detected(objs, True)
+    assert all(o.state == SlotState.READY for o in objs)
+    first = ring.next_ready()
+    second = ring.next_ready()
+    assert first is objs[0] and second is objs[1]
+    assert (first.img == 0).all() and (second.img == 1).all()
+    assert first.prepared.frame == 0 and second.prepared.frame == 1
+    assert ring.next_ready() is None
+    assert ring.ended()
+    assert ring.held() == {first.prepared.idx, second.prepared.idx}
+
+    ring.release(first.prepared.idx)
+    assert first.state == SlotState.FREE and first.seq == -1
+    assert ring.held() == {second.prepared.idx}
+
+    stats = ring.stats()
+    assert (stats.capture.frames, stats.detect.frames, stats.send.frames) == (2, 2, 2)
+
+
+def test_failed_detection(mk_ring):
+    ring = mk_ring(1)
+    wait_until(ring, lambda: ring.capture_done)
+    objs = ring.take_captured(1, wait_for_batch=False)
+    ring.detected(objs, False)
+    assert objs[0].state == SlotState.FREE
+    assert ring.ended()
+    assert ring.stats().detect.dropped == 1
+
+
+def test_block_when_full(mk_ring):
+    ring = mk_ring(10)
+    wait_until(ring, stalled(ring))
+    assert ring.capture_stats.frames == 3
+    assert [o.seq for o in ring.unsent()] == [0, 1, 2]
+
+    # Sent images are held, the capture thread waits until one is released
+    o = send_next(ring)
+    assert ring.capture_stats.frames == 3
+    ring.release(o.prepared.idx)
+    wait_until(ring, lambda: ring.capture_stats.frames == 4)
+    assert [o.seq for o in ring.unsent()] == [1, 2, 3]
+    assert ring.stats().capture.dropped == 0
+
+
+def test_drop_oldest(mk_ring):
+    ring = mk_ring(10, policy="drop_oldest")
+    wait_until(ring, lambda: ring.capture_done)
+    # The read which finds the end of the source also took the place of the
+    # oldest frame
+    assert [o.seq for o in ring.unsent()] == [8, 9]
+    assert [int(o.img[0, 0, 0]) for o in ring.unsent()] == [8, 9]
+    assert ring.detect_stats.dropped == 8
+
+
+def test_drop_oldest_held(mk_ring):
+    ring = mk_ring(10, policy="drop_oldest", gated=True)
+    src = cast(CountingSource, ring.src)
+    src.allow(3)
+    # The place of the oldest frame is taken before reading the next one
+    wait_until(ring, lambda: ring.capture_stats.frames == 3)
+    wait_until(ring, lambda: len(ring.unsent()) == 2)
+    held = send_next(ring)
+    assert held.seq == 1
+
+    # Held images are never overwritten
+    src.allow(3)
+    wait_until(ring, lambda: ring.capture_stats.frames == 6)
+    wait_until(ring, lambda: len(ring.unsent()) == 1)
+    assert [o.seq for o in ring.unsent()] == [5]
+    assert held.seq == 1 and (held.img == 1).all()
+    assert ring.detect_stats.dropped == 4
+
+
+def test_latest_only(mk_ring):
+    ring = mk_ring(10, policy="latest_only")
+    wait_until(ring, lambda: ring.capture_done)
+    assert [o.seq for o in ring.unsent()] == [9]
+    assert ring.detect_stats.dropped == 9
+    o = send_next(ring)
+    assert (o.img == 9).all()
+
+
+@pytest.mark.parametrize("depth", [3, 4])
+def test_wrap_around(mk_ring, depth: int):
+    ring = mk_ring(20, depth=depth)
+    idxs: list[int] = []
+    for frame in range(20):
+        wait_until(ring, lambda: ring.unsent())
+        o = send_next(ring)
+        assert o.seq == frame
+        assert (o.img == frame).all()
+        idxs.append(o.prepared.idx)
+        ring.release(o.prepared.idx)
+    # Images are reused in turn
+    assert idxs == [frame % depth for frame in range(20)]
+    wait_until(ring, lambda: ring.capture_done)
+    assert ring.ended()
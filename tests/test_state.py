@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("PySide6")
+
+from cv_project.demo.detection.schemas import Klass, mk_detections  # noqa: E402
+from cv_project.demo.state import SceneDiff, State, scene  # noqa: E402
+
+
+def detections(*objects: tuple[int, Klass, float, int, int, int, int]):
+    res = mk_detections(len(objects))
+    for idx, (id, klass, confidence, x1, y1, x2, y2) in enumerate(objects):
+        res[idx] = (id, klass.value, confidence, x1, y1, x2, y2, False)
+    return res
+
+
+def commit(state: State, detected: np.ndarray) -> SceneDiff:
+    diffs: list[SceneDiff] = []
+    _ = state.frame_committed.connect(diffs.append)
+    state.commit(*scene(detected))
+    _ = state.frame_committed.disconnect(diffs.append)
+    assert len(diffs) == 1
+    return diffs[0]
+
+
+CHICKEN = (7, Klass.Chicken, 0.9, 0, 0, 100, 100)
+EGG = (1000, Klass.Egg, 0.8, 110, 0, 120, 10)
+
+
+def test_scene_by_id():
+    # Ids are larger than the number of detections
+    objects, chickens, eggs = scene(detections(CHICKEN, EGG))
+    assert objects.keys() == {7, 1000}
+    assert chickens.keys() == {7}
+    assert eggs.keys() == {1000}
+    assert eggs[1000].chicken is chickens[7]
+    assert chickens[7].eggs == [eggs[1000]]
+
+
+def test_scene_thresholds():
+    detected = detections(CHICKEN, EGG)
+    objects, _, eggs = scene(detected, confidence_threshold=85)
+    assert objects.keys() == {7}
+    assert eggs == {}
+    objects, chickens, eggs = scene(detected, hide_chickens=True)
+    assert objects.keys() == {1000}
+    assert chickens == {}
+    assert eggs[1000].chicken is None
+
+
+def test_commit_added_removed():
+    state = State()
+    diff = commit(state, detections(CHICKEN))
+    assert diff == SceneDiff(added={7})
+
+    diff = commit(state, detections(EGG))
+    assert diff == SceneDiff(added={1000}, removed={7})
+    assert state.objects.keys() == {1000}
+
+
+def test_commit_unchanged():
+    state = State()
+    _ = commit(state, detections(CHICKEN, EGG))
+    assert commit(state, detections(CHICKEN, EGG)) == SceneDiff()
+
+    # Labels show the confidence rounded to 2 digits
+    chicken = (7, Klass.Chicken, 0.901, 0, 0, 100, 100)
+    egg = (1000, Klass.Egg, 0.5, 110, 0, 120, 10)
+    assert commit(state, detections(chicken, egg)) == SceneDiff()
+
+
+def test_commit_updated():
+    state = State()
+    _ = commit(state, detections(CHICKEN, EGG))
+
+    # The chicken moves, so does the link of its egg
+    chicken = (7, Klass.Chicken, 0.9, 0, 5, 100, 105)
+    assert commit(state, detections(chicken, EGG)) == SceneDiff(updated={7, 1000})
+
+    chicken = (7, Klass.Chicken, 0.8, 0, 5, 100, 105)
+    assert commit(state, detections(chicken, EGG)) == SceneDiff(updated={7})
+
+    # The egg gets another chicken
+    near = (8, Klass.Chicken, 0.9, 115, 11, 140, 40)
+    diff = commit(state, detections(chicken, near, EGG))
+    assert diff == SceneDiff(added={8}, updated={7, 1000})
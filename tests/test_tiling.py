@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from cv_project.tiling import merge_boxes, tile_rects
+
+
+@pytest.mark.parametrize("grid", [(1, 1), (2, 1), (3, 2), (4, 4)])
+@pytest.mark.parametrize("overlap", [0.0, 0.2, 0.5])
+def test_tiles_cover_rect(grid: tuple[int, int], overlap: float):
+    rect = (10, 20, 1290, 740)
+    tiles = tile_rects(rect, grid, overlap)
+    assert len(tiles) == grid[0] * grid[1]
+
+    covered = np.zeros((740, 1290), dtype=np.int64)
+    for x1, y1, x2, y2 in tiles:
+        assert rect[0] <= x1 < x2 <= rect[2]
+        assert rect[1] <= y1 < y2 <= rect[3]
+        covered[y1:y2, x1:x2] += 1
+    assert (covered[20:, 10:] > 0).all()
+    assert (covered[:20] == 0).all() and (covered[:, :10] == 0).all()
+
+
+def test_tiles_overlap():
+    tiles = tile_rects((0, 0, 1000, 100), (3, 1), 0.2)
+    widths = [x2 - x1 for x1, _, x2, _ in tiles]
+    assert max(widths) - min(widths) <= 1
+    for (_, _, end, _), (start, _, _, _) in zip(tiles, tiles[1:]):
+        assert end - start == pytest.approx(0.2 * widths[0], abs=1)
+
+
+def boxes(*rows: tuple[float, float, float, float, float, float]):
+    return np.array(rows, dtype=np.float32).reshape(-1, 6)
+
+
+def test_merge_keeps_most_confident():
+    # The same egg cut at a tile border, and found whole in the next tile
+    cut = (90, 10, 100, 30, 0.6, 1)
+    whole = (90, 10, 110, 30, 0.8, 1)
+    other = (300, 10, 320, 30, 0.7, 1)
+    merged = merge_boxes(boxes(cut, whole, other), np.array([0, 1, 1]))
+    assert merged.tolist() == boxes(whole, other).tolist()
+
+
+def test_merge_other_class():
+    egg = (90, 10, 100, 30, 0.6, 1)
+    chicken = (80, 0, 120, 40, 0.8, 0)
+    merged = merge_boxes(boxes(egg, chicken), np.array([0, 1]))
+    assert len(merged) == 2
+
+
+def test_merge_same_tile():
+    # Touching eggs, one mostly in front of the other
+    front = (100, 100, 130, 140, 0.9, 1)
+    back = (110, 105, 135, 140, 0.7, 1)
+    assert len(merge_boxes(boxes(front, back), np.array([2, 2]))) == 2
+    assert len(merge_boxes(boxes(front, back), np.array([2, 3]))) == 1
+    assert len(merge_boxes(boxes(front, back))) == 1
+
+
+def test_merge_few_boxes():
+    assert len(merge_boxes(boxes())) == 0
+    assert len(merge_boxes(boxes((0, 0, 10, 10, 0.5, 1)))) == 1
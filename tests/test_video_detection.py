@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("ultralytics")
+
+from cv_project.running.video_detection import (  # noqa: E402
+    global_ids,
+    matched_ids,
+    with_ids,
+)
+
+CHICKEN, EGG = 0, 1
+
+
+def frame(*tracks: tuple[int, float, int]):
+    """Boxes of a frame from id, x and class of each track"""
+    return np.array(
+        [(x, 0, x + 50, 50, id, 0.9, cls) for id, x, cls in tracks], dtype=np.float32
+    ).reshape(-1, 7)
+
+
+def test_matched_ids():
+    before = [frame((3, 0, CHICKEN), (4, 100, EGG)) for _ in range(5)]
+    after = [frame((0, 2, CHICKEN), (1, 101, EGG), (2, 300, EGG)) for _ in range(5)]
+    assert matched_ids(before, after) == {0: 3, 1: 4}
+
+
+def test_matched_ids_same_class():
+    before = [frame((3, 0, CHICKEN))]
+    after = [frame((0, 0, EGG))]
+    assert matched_ids(before, after) == {}
+
+
+def test_matched_ids_most_votes():
+    # Two tracks of the next segment follow track 3, the longer one keeps it
+    before = [frame((3, 0, CHICKEN)) for _ in range(5)]
+    after = [frame((0, 0, CHICKEN))] * 2 + [frame((1, 0, CHICKEN))] * 3
+    assert matched_ids(before, after) == {1: 3}
+
+
+def test_global_ids():
+    # Track 0 of the first segment goes on as track 1 of the second one
+    first = frame((0, 0, CHICKEN), (1, 200, EGG))
+    second = frame((0, 400, EGG), (1, 1, CHICKEN))
+    third = frame((0, 2, CHICKEN))
+    segments = [
+        ([0, 1], [], [first, first]),
+        ([0, 1], [second, second], [second]),
+        ([0], [third], [third]),
+    ]
+    ids = global_ids(segments)
+    assert ids[0] == {0: 0, 1: 1}
+    assert ids[1] == {1: 0, 0: 2}
+    assert ids[2] == {0: 0}
+
+
+def test_global_ids_unique():
+    # Nothing carries over: every track gets an id of its own
+    segments = [
+        ([0, 1], [], [frame((0, 0, CHICKEN), (1, 100, EGG))]),
+        ([0, 1, 2], [frame((0, 500, CHICKEN))], [frame()]),
+        ([0], [frame((0, 0, CHICKEN))], [frame()]),
+    ]
+    ids = global_ids(segments)
+    values = [i for to_global in ids for i in to_global.values()]
+    assert sorted(values) == list(range(6))
+
+
+def test_with_ids():
+    boxes = frame((0, 0, CHICKEN), (1, 100, EGG))
+    boxes[1, 4] = -1
+    res = with_ids(boxes, {0: 7})
+    assert res[:, 4].tolist() == [7, -1]
+    assert boxes[:, 4].tolist() == [0, -1]